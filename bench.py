@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Benchmarks for stow.py on large synthetic stow directories, generated with
+jsondirs.  Each case times planning and processing a stow and an unstow
+of every package separately and counts the filesystem calls made while
+planning.  Results can be saved as a JSON baseline, and a later run
+checked against one: it fails if a case made more filesystem calls or
+queued more tasks than before, or became much slower.
+
+bench-baseline.json holds the counts for the default cases, which do not
+depend on the machine; regenerate it with --save FILE --counts.
+"""
+
+from __future__ import print_function
+import jsondirs
+import stow
+import json, os, shutil, sys, tempfile, time
+
+layouts = ("wide", "deep", "overlap", "nofold")
+
+
+def package_tree(layout, nodes, index, depth=16):
+    """
+    The tree of one package with about the given number of nodes
+    wide: a bushy tree with 8 entries (2 of them dirs) per dir
+    deep: chains of dirs depth levels deep with one file on each level
+    Both are under a top-level dir of their own, which stow_tree() also
+    creates in the target, so stowing walks the whole package.
+    overlap/nofold: a wide tree under the same dir for every package, so
+    each package unfolds the dirs stowed by the ones before it
+    """
+    top = "pkg{}".format(index) if layout in ("wide", "deep") else "share"
+    root = {}
+
+    if layout == "deep":
+        count = 0
+        while count < nodes:
+            dir = root.setdefault("c{}".format(count // (2 * depth)), {})
+            for level in range(depth):
+                dir["p{}_f{}".format(index, level)] = ""
+                dir = dir.setdefault("d", {})
+                count += 2
+        return {top: root}
+
+    queue = [root]
+    for count in range(nodes):
+        dir = queue[count // 8]
+        if count % 8 < 2:
+            dir["d{}".format(count % 8)] = sub = {}
+            queue.append(sub)
+        else:
+            dir["p{}_f{}".format(index, count)] = ""
+    return {top: root}
+
+
+def skeleton(tree):
+    """
+    The dirs of tree without its files
+    """
+    return {name: skeleton(node) for name, node in tree.items()
+            if isinstance(node, dict)}
+
+
+def stow_tree(layout, nodes, packages):
+    """
+    The stow dir of a generated tree and, for the wide and deep layouts,
+    the dirs of every package as real dirs in the target, so that nothing
+    folds and planning has to descend to every file
+    """
+    per_package = max(1, nodes // packages)
+    tree = {"stow": {"pkg{}".format(i): package_tree(layout, per_package, i)
+                     for i in range(packages)}}
+    if layout in ("wide", "deep"):
+        for package in tree["stow"].values():
+            tree.update(skeleton(package))
+    return tree
+
+
+def fs_calls(s):
+    return sum(r["value"] for r in s.stats.records()
+               if r["metric"] == "fs_calls")
+
+
+def run_case(layout, nodes, packages, workdir, jobs=1):
+    """
+    Stow and then unstow every package of a generated tree, returning
+    the timings and counts of each phase
+    """
+    dir = os.path.join(workdir, "{}-{}".format(layout, nodes))
+    jsondirs.mktree(stow_tree(layout, nodes, packages), dir)
+    stowdir = os.path.join(dir, "stow")
+    names = ["pkg{}".format(i) for i in range(packages)]
+    result = {}
+
+    for action in ("stow", "unstow"):
+        s = stow.Stow(dir, stowdir, jobs=jobs, stats=True)
+        s.no_folding = layout == "nofold"
+
+        start = time.time()
+        getattr(s, "plan_" + action)(names)
+        result["plan_" + action] = time.time() - start
+        result["fs_calls_" + action] = fs_calls(s)
+        result["tasks_" + action] = len(s.tasks)
+
+        start = time.time()
+        s.process_tasks()
+        result["process_" + action] = time.time() - start
+
+    shutil.rmtree(dir)
+    return result
+
+
+def check(results, baseline, slowdown):
+    """
+    Compare results against a baseline, returning a list of regressions
+    """
+    failures = []
+    for case, old in sorted(baseline.items()):
+        new = results.get(case)
+        if new is None:
+            continue
+        for key, value in sorted(old.items()):
+            if key not in new:
+                continue
+            if key.startswith(("fs_calls_", "tasks_")):
+                regressed = new[key] > value
+            else:
+                # Ignore noise on timings too small to measure reliably
+                regressed = new[key] > max(value * slowdown, value + 0.05)
+            if regressed:
+                failures.append("{} {}: {} -> {}".format(
+                    case, key, value, new[key]))
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--layout", action="append", choices=layouts,
+            help="Layouts to run (default: all)")
+    parser.add_argument("--nodes", type=int, action="append", metavar="N",
+            help="Approximate node counts to run (default: 1000 10000)")
+    parser.add_argument("--packages", type=int, default=10, metavar="N",
+            help="Number of packages to split each tree into")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+            help="Worker threads for stow.py")
+    parser.add_argument("--save", metavar="FILE",
+            help="Write the results to FILE as a baseline")
+    parser.add_argument("--counts", action="store_true",
+            help="Only save the filesystem call and task counts")
+    parser.add_argument("--check", metavar="FILE",
+            help="Fail if the results regress from the baseline in FILE")
+    parser.add_argument("--slowdown", type=float, default=2.0, metavar="X",
+            help="Timing regression factor tolerated by --check")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="stow-bench-")
+    results = {}
+    try:
+        for nodes in args.nodes or [1000, 10000]:
+            for layout in args.layout or layouts:
+                case = "{}-{}".format(layout, nodes)
+                results[case] = run_case(layout, nodes, args.packages,
+                                         workdir, args.jobs)
+                print(case, " ".join(
+                    ("{}={:.4f}" if isinstance(v, float) else "{}={}")
+                    .format(k, v) for k, v in sorted(results[case].items())))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.save:
+        if args.counts:
+            results = {case: {k: v for k, v in result.items()
+                              if k.startswith(("fs_calls_", "tasks_"))}
+                       for case, result in results.items()}
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write("\n")
+    if args.check:
+        with open(args.check) as f:
+            failures = check(results, json.load(f), args.slowdown)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        sys.exit(1 if failures else 0)
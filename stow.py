@@ -22,10 +22,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 from __future__ import print_function
-from collections import namedtuple
-from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager, nullcontext
 from warnings import warn
-import inspect, os, re, sys
+import copy, errno, functools, inspect, json, os, re, shutil, stat, sys
+import select, struct, threading, time
 
 version = "0.0.1"
 
@@ -36,7 +37,11 @@ def join_paths(*args):
     return os.path.normpath(os.path.join(*args))
 
 class Task:
+    # Actions and types are shared interned strings, so a task only holds
+    # references to them and comparing them is a pointer check
     class Link:
+        __slots__ = ("action", "type", "source", "path")
+
         def __init__(self, action, type, source, path):
             self.action = action
             self.type = type
@@ -44,40 +49,748 @@ class Task:
             self.path = path
 
     class Dir:
+        __slots__ = ("action", "type", "path")
+
         def __init__(self, action, type, path):
             self.action = action
             self.type = type
             self.path = path
 
     class Mv:
+        __slots__ = ("path", "dest")
         action = "move"
         type = "file"
+
         def __init__(self, path, dest):
             self.path = path
             self.dest = dest
 
-def debug(level, msg):
-    if debug_level < level:
-        return
+def node_kind(mode):
+    if stat.S_ISLNK(mode):
+        return "link"
+    if stat.S_ISDIR(mode):
+        return "dir"
+    return "file"
+
+def entry_kind(entry):
+    # DirEntry answers these from the d_type returned by readdir
+    # wherever the filesystem provides it
+    if entry.is_symlink():
+        return "link"
+    if entry.is_dir(follow_symlinks=False):
+        return "dir"
+    return "file"
+
+class DirFds:
+    """
+    Bounded LRU of open file descriptors for directories below root.
+    Operations on a path pass the descriptor of its directory as dir_fd,
+    so the kernel only resolves the final component rather than walking
+    the whole path again.  Where the platform lacks dir_fd support, and
+    for absolute paths, paths are simply joined onto root.
+    """
+
+    # os.lstat is never listed in supports_dir_fd; lstat() calls os.stat
+    # with follow_symlinks=False instead
+    supported = {os.open, os.stat, os.readlink, os.mkdir,
+                 os.rmdir, os.unlink, os.symlink, os.rename} <= \
+            os.supports_dir_fd and os.scandir in os.supports_fd
+
+    flags = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+
+    def __init__(self, root, size=128):
+        self.root = os.path.abspath(root)
+        self.size = size
+        self.fds = OrderedDict() # dir => [fd, users]
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            for dir in list(self.fds):
+                self.drop(dir)
+
+    def drop(self, dir):
+        # Descriptors still in use are closed by release()
+        entry = self.fds.pop(dir)
+        if not entry[1]:
+            os.close(entry[0])
+
+    def forget(self, path):
+        """
+        Close the descriptors of path and everything below it, which no
+        longer name the same directories once path is removed or renamed
+        """
+        prefix = path + os.sep
+        with self.lock:
+            for dir in list(self.fds):
+                if dir == path or dir.startswith(prefix):
+                    self.drop(dir)
+
+    def acquire(self, dir):
+        with self.lock:
+            entry = self.fds.get(dir)
+            if entry is not None:
+                self.fds.move_to_end(dir)
+                entry[1] += 1
+                return entry
+
+        if dir:
+            with self.at(dir) as (parent_fd, name):
+                fd = os.open(name, self.flags, dir_fd=parent_fd)
+        else:
+            fd = os.open(self.root, self.flags)
+
+        with self.lock:
+            entry = self.fds.get(dir)
+            if entry is not None:
+                # Another thread opened it meanwhile
+                os.close(fd)
+                entry[1] += 1
+                return entry
+            entry = self.fds[dir] = [fd, 1]
+
+            for old in list(self.fds):
+                if len(self.fds) <= self.size:
+                    break
+                if not self.fds[old][1]:
+                    self.drop(old)
+            return entry
+
+    def release(self, dir, entry):
+        with self.lock:
+            entry[1] -= 1
+            if not entry[1] and self.fds.get(dir) is not entry:
+                os.close(entry[0])
+
+    def is_fs_root(self, dir):
+        """
+        Whether dir resolves to the filesystem root
+        """
+        dir = os.path.normpath(os.path.join(self.root, dir))
+        return os.path.dirname(dir) == dir
+
+    @contextmanager
+    def at(self, path):
+        """
+        Yield (dir_fd, name) addressing path
+        """
+        dir, name = os.path.split(path)
+        # Splitting the filesystem root gives back the root itself, so
+        # paths which start from or climb up to it are never split further
+        if not self.supported or not name or os.path.isabs(path) or \
+                path.startswith(os.pardir) and self.is_fs_root(dir):
+            yield None, os.path.join(self.root, path)
+            return
+
+        entry = self.acquire(dir)
+        try:
+            yield entry[0], name
+        finally:
+            self.release(dir, entry)
+
+    def lstat(self, path):
+        with self.at(path) as (fd, name):
+            return os.stat(name, dir_fd=fd, follow_symlinks=False)
+
+    def stat(self, path):
+        with self.at(path) as (fd, name):
+            return os.stat(name, dir_fd=fd)
+
+    def readlink(self, path):
+        with self.at(path) as (fd, name):
+            return os.readlink(name, dir_fd=fd)
+
+    def scandir(self, path):
+        """
+        List the directory at path as (name, kind) pairs
+        """
+        with self.at(path) as (fd, name):
+            if fd is None:
+                with os.scandir(name) as entries:
+                    return [(entry.name, entry_kind(entry))
+                            for entry in entries]
+
+            # scandir moves the offset of the descriptor it is given, so
+            # use a private one rather than sharing the cached descriptor
+            dir_fd = os.open(name, self.flags, dir_fd=fd)
+            try:
+                with os.scandir(dir_fd) as entries:
+                    return [(entry.name, entry_kind(entry))
+                            for entry in entries]
+            finally:
+                os.close(dir_fd)
+
+    def mkdir(self, path):
+        with self.at(path) as (fd, name):
+            os.mkdir(name, dir_fd=fd)
+
+    def rmdir(self, path):
+        with self.at(path) as (fd, name):
+            os.rmdir(name, dir_fd=fd)
+        self.forget(path)
+
+    def symlink(self, source, path):
+        with self.at(path) as (fd, name):
+            os.symlink(source, name, dir_fd=fd)
+
+    def unlink(self, path):
+        with self.at(path) as (fd, name):
+            os.unlink(name, dir_fd=fd)
+        self.forget(path)
+
+    def rename(self, path, dest):
+        with self.at(path) as (fd, name), self.at(dest) as (dest_fd, dest_name):
+            os.rename(name, dest_name, src_dir_fd=fd, dst_dir_fd=dest_fd)
+        self.forget(path)
+
+class FsCache:
+    """
+    Per-run cache of node types and link sources, keyed by normalized path
+    relative to the target directory and looked up through DirFds.
+    Planning never modifies the filesystem, so a cached answer stays valid
+    until the planned tasks are processed.
+
+    Nodes are recorded by kind ("link", "dir", "file" or None if absent)
+    rather than by full stat result, so that a single directory listing
+    can answer the lstat question for every child of that directory.
+
+    Listings below the stow directory at target path source can also be
+    kept in index, a dict keyed by path relative to the stow directory
+    which several instances for different targets may share.  Packages
+    are assumed not to change while it is shared.  If scanned is a dict,
+    listings for index are also taken from and recorded in it, keyed the
+    same way and stamped with the inode and mtime of the directory, so
+    that it can persist between runs (see Stow.read_scan_cache()).
+
+    If listed is a set, the path of every directory listed is added to
+    it, so that the listings planning relied on can be fingerprinted.
+    """
+
+    def __init__(self, dirs, stats=None, index=None, source=None,
+                 scanned=None, listed=None):
+        self.dirs = dirs
+        self.stats = stats
+        self.index = index
+        self.source = source
+        self.scanned = scanned
+        self.listed = listed
+        self.rescanned = False
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.kinds = {}
+        self.targets = {}
+        self.links = {}
+        self.listings = {}
+
+    def lookup(self, table, fn, path):
+        try:
+            result = table[path]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+
+        self.misses += 1
+        if self.stats:
+            self.stats.syscall(fn.__name__)
+        try:
+            result = fn(path)
+        except (OSError, ValueError):
+            result = None
+        table[path] = result
+        return result
+
+    def kind(self, path):
+        """
+        Type of the node at path without following a final symlink
+        """
+        try:
+            result = self.kinds[path]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
 
+        # Anything missing from the listing of its parent does not exist,
+        # and the shared index may have that listing already
+        parent = os.path.dirname(path) or os.curdir
+        if parent not in self.listings and self.index_key(parent) and \
+                self.index_key(parent) in self.index:
+            self.listdir(parent)
+            return self.kind(path)
+        if parent in self.listings:
+            self.hits += 1
+            return None
+        # Nor does anything below a parent known to be missing or a file,
+        # such as a directory which planning has only just unfolded
+        if self.kinds.get(parent, "dir") in (None, "file"):
+            self.hits += 1
+            self.kinds[path] = None
+            return None
+
+        self.misses += 1
+        if self.stats:
+            self.stats.syscall("lstat")
+        try:
+            result = node_kind(self.dirs.lstat(path).st_mode)
+        except (OSError, ValueError):
+            result = None
+        self.kinds[path] = result
+        return result
+
+    def target_kind(self, path):
+        """
+        Type of the node at path after following symlinks
+        """
+        kind = self.kind(path)
+        if kind != "link":
+            return kind
+        st = self.lookup(self.targets, self.dirs.stat, path)
+        return st and node_kind(st.st_mode)
+
+    def exists(self, path):
+        return self.target_kind(path) is not None
+
+    def islink(self, path):
+        return self.kind(path) == "link"
+
+    def isdir(self, path):
+        return self.target_kind(path) == "dir"
+
+    def readlink(self, path):
+        source = self.lookup(self.links, self.dirs.readlink, path)
+        if source is None:
+            raise OSError("could not read link: " + path)
+        return source
+
+    def listdir(self, path):
+        """
+        List the directory at path as (name, kind) pairs, recording the
+        kind of every child so later lookups need no further syscalls
+        """
+        if self.listed is not None:
+            self.listed.add(path)
+        try:
+            result = self.listings[path]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+
+        key = self.index_key(path)
+        result = self.index.get(key) if key else None
+        if result is None:
+            self.misses += 1
+            result = self.scan(path, key)
+            if key:
+                self.index[key] = result
+        else:
+            self.hits += 1
+        for name, kind in result:
+            self.kinds[join_paths(path, name)] = kind
+        self.listings[path] = result
+        return result
+
+    def scan(self, path, key):
+        """
+        List the directory at path, unless scanned has a listing of it
+        from when it had the same inode and mtime as now
+        """
+        stamp = None
+        if key and self.scanned is not None:
+            if self.stats:
+                self.stats.syscall("stat")
+            try:
+                st = self.dirs.stat(path)
+                stamp = [st.st_ino, st.st_mtime_ns]
+            except (OSError, ValueError):
+                pass
+            record = self.scanned.get(key)
+            if stamp and record and record[:2] == stamp:
+                return record[2]
+
+        if self.stats:
+            self.stats.syscall("listdir")
+        result = self.dirs.scandir(path)
+        # A directory changed within the last second could change again
+        # without its mtime moving on, so only trust older ones
+        if stamp and time.time_ns() - stamp[1] > 1000000000:
+            self.scanned[key] = stamp + [result]
+            self.rescanned = True
+        return result
+
+    def index_key(self, path):
+        """
+        The key of path in the shared index of package listings, or None
+        if we have no index or path is not below the stow directory
+        """
+        if self.index is None or self.source == os.curdir:
+            return None
+        if path == self.source:
+            return os.curdir
+        if path.startswith(self.source + os.sep):
+            return path[len(self.source) + 1:]
+        return None
+
+class TaskTrie:
+    """
+    Planned link and dir tasks indexed by path component.  A lookup
+    descends the trie once, finding the tasks planned at a path and
+    noting on the way down whether a link at or above it is scheduled
+    for removal.
+    """
+
+    class Node:
+        __slots__ = ("children", "link", "dir")
+
+        # Most nodes are leaves, which share this instead of an empty dict
+        no_children = {}
+
+        def __init__(self):
+            self.children = TaskTrie.Node.no_children
+            self.link = None
+            self.dir = None
+
+    def __init__(self, reads=None):
+        self.root = TaskTrie.Node()
+        # Optionally record every path looked up, see Stow.plan_packages
+        self.reads = reads
+
+    def lookup(self, path):
+        """
+        Returns (link task, dir task, link removal at or above path)
+        """
+        if self.reads is not None:
+            self.reads.add(path)
+        node = self.root
+        removed = False
+        for part in path.split(os.sep):
+            node = node.children.get(part)
+            if node is None:
+                return None, None, removed
+            if node.link is not None and node.link.action == "remove":
+                removed = True
+        return node.link, node.dir, removed
+
+    def node(self, path):
+        if self.reads is not None:
+            self.reads.add(path)
+        node = self.root
+        for part in path.split(os.sep):
+            child = node.children.get(part)
+            if child is None:
+                if not node.children:
+                    node.children = {}
+                child = node.children[part] = TaskTrie.Node()
+            node = child
+        return node
+
+    def touches(self, path):
+        """
+        Whether any task is planned at path or at one of its ancestors
+        """
+        node = self.root
+        for part in path.split(os.sep):
+            node = node.children.get(part)
+            if node is None:
+                return False
+            if node.link is not None or node.dir is not None:
+                return True
+        return False
+
+    def prune(self, name):
+        """
+        Forget every task at or below the top-level path component name
+        """
+        self.root.children.pop(name, None)
+
+    def link(self, path):
+        return self.lookup(path)[0]
+
+    def dir(self, path):
+        return self.lookup(path)[1]
+
+def combine_regexps(regexps, template="(?:{})"):
+    """
+    Merge compiled regexps into one alternation so that a single search
+    tries them all.  Patterns which cannot be merged, e.g. because of
+    inline flags, are kept as they are; returns a list of regexps.
+    Patterns with capture groups are never merged, since the merged
+    pattern would renumber the groups their backreferences refer to.
+    """
+    merge = [r for r in regexps if not r.groups]
+    keep = [r for r in regexps if r.groups]
+    flags = set(r.flags for r in merge)
+    if len(merge) < 2 or len(flags) > 1:
+        return list(regexps)
+    try:
+        return [re.compile("|".join(template.format(r.pattern)
+                                    for r in merge), flags.pop())] + keep
+    except re.error:
+        return list(regexps)
+
+class Ignores:
+    """
+    The ignore list of one package, in the format of GNU stow's
+    .stow-local-ignore.  Patterns containing a slash are matched against
+    the path below the package and all others against the node name; each
+    kind is compiled into a single regexp.
+    """
+
+    defaults = [
+        r"RCS",
+        r".+,v",
+        r"CVS",
+        r"\.\#.+",
+        r"\.cvsignore",
+        r"\.svn",
+        r"_darcs",
+        r"\.hg",
+        r"\.git",
+        r"\.gitignore",
+        r"\.gitmodules",
+        r".+~",
+        r"\#.*\#",
+        r"^/README.*",
+        r"^/LICENSE.*",
+        r"^/COPYING",
+    ]
+
+    def __init__(self, patterns):
+        paths = [p for p in patterns if "/" in p]
+        names = [p for p in patterns if "/" not in p]
+        self.path = re.compile(r"(^|/)(" + "|".join(paths) + r")(/|$)") \
+                if paths else None
+        self.name = re.compile(r"^(" + "|".join(names) + r")$") \
+                if names else None
+
+    @classmethod
+    def read(cls, file):
+        """
+        The patterns listed in an ignore file, or None if it cannot be read
+        """
+        try:
+            with open(file) as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return None
+
+        patterns = []
+        for line in lines:
+            line = re.sub(r"^#.*", "", line)
+            line = re.sub(r"\s+#.+", "", line)
+            line = line.replace(r"\#", "#").strip()
+            if line:
+                patterns.append(line)
+        return patterns
+
+    def match(self, target):
+        if self.path and self.path.search("/" + target):
+            return True
+        return bool(self.name and self.name.search(os.path.basename(target)))
+
+class TaskQueue:
+    """
+    Planned tasks in the order they were queued.  Tasks are the keys of an
+    insertion-ordered dict, so that a task which a later one reverts is
+    dropped in O(1) instead of being left behind for process_tasks().
+    """
+
+    __slots__ = ("tasks",)
+
+    def __init__(self, tasks=()):
+        self.tasks = dict.fromkeys(tasks)
+
+    def append(self, task):
+        self.tasks[task] = None
+
+    def remove(self, task):
+        del self.tasks[task]
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+def task_paths(task):
+    if task.action == "move":
+        return (task.path, task.dest)
+    return (task.path,)
+
+class TaskOrder:
+    """
+    Trie node used by task_dependencies().  last is the index of the most
+    recent task at this path, since the indices of tasks queued below
+    this path after that one.
+    """
+    __slots__ = ("children", "last", "since")
+
+    def __init__(self):
+        self.children = {}
+        self.last = None
+        self.since = []
+
+def task_dependencies(tasks):
+    """
+    For each task, find the earlier tasks which must complete before it
+    may run.  Two tasks depend on each other when the path of one is the
+    path of the other or one of its ancestors: a mkdir runs before the
+    links created inside it, an unlink before the mkdir replacing it, an
+    rmdir after the unlinks emptying it.  Those pairs keep their queue
+    order; all other tasks are independent.
+    """
+    root = TaskOrder()
+    deps = []
+    for i, task in enumerate(tasks):
+        before = set()
+        for path in task_paths(task):
+            node = root
+            for part in path.split(os.sep):
+                if node is not root:
+                    if node.last is not None:
+                        before.add(node.last)
+                    node.since.append(i)
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = TaskOrder()
+                node = child
+            if node.last is not None:
+                before.add(node.last)
+            before.update(node.since)
+            node.last = i
+            node.since = []
+        before.discard(i)
+        deps.append(before)
+    return deps
+
+class Stats:
+    """
+    Counters and timers describing one run, for --stats.  Filesystem
+    calls are attributed to the innermost instrumented Stow method (see
+    instrumented()) running in the calling thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = OrderedDict()
+        self.local = threading.local()
+
+    def add(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    @contextmanager
+    def within(self, method):
+        stack = self.local.__dict__.setdefault("methods", [])
+        stack.append(method)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def syscall(self, op):
+        stack = getattr(self.local, "methods", None)
+        self.add("fs_calls", op=op, method=stack[-1] if stack else "other")
+
+    @contextmanager
+    def timed(self, phase, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add("seconds", time.time() - start, phase=phase, **labels)
+
+    def records(self):
+        with self.lock:
+            return [{"metric": metric, "labels": dict(labels), "value": value}
+                    for (metric, labels), value in self.counts.items()]
+
+    def text(self):
+        lines = []
+        for record in sorted(self.records(), key=lambda r: r["metric"]):
+            fields = [record["metric"]]
+            fields += ["{}={}".format(k, v)
+                       for k, v in sorted(record["labels"].items())]
+            value = record["value"]
+            if isinstance(value, float):
+                value = "{:.6f}".format(value)
+            lines.append(" ".join(fields + [str(value)]))
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        return json.dumps(self.records(), indent=1, sort_keys=True) + "\n"
+
+    def prometheus(self):
+        """
+        The counters in the Prometheus text exposition format
+        """
+        lines = []
+        last = None
+        for record in sorted(self.records(), key=lambda r: r["metric"]):
+            if record["metric"] == "seconds":
+                name, type = "stow_seconds", "gauge"
+            else:
+                name, type = "stow_" + record["metric"] + "_total", "counter"
+            if name != last:
+                lines.append("# TYPE {} {}".format(name, type))
+                last = name
+            labels = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                    .replace("\n", "\\n").replace('"', '\\"'))
+                for k, v in sorted(record["labels"].items()))
+            if labels:
+                name_labels = "{}{{{}}}".format(name, labels)
+            else:
+                name_labels = name
+            lines.append("{} {}".format(name_labels, record["value"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file):
+        """
+        Atomically replace file, e.g. for node_exporter's textfile collector
+        """
+        with open(file + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(file + ".tmp", file)
+
+def instrumented(method):
+    """
+    Decorate a Stow method so that --stats attributes the filesystem calls
+    made while it runs to it
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is None:
+            return method(self, *args, **kwargs)
+        with self.stats.within(name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def report(msg):
     if test_mode:
         print(msg)
     else:
         warn(msg)
 
-def debug_fn(level, msg = "", indent = 0):
-    if debug_level < level:
-        return
+def debug(level, msg):
+    # Only for module level helpers; Stow instances use their own verbosity
+    if debug_level >= level:
+        report(msg)
 
-    caller = inspect.currentframe().f_back
-    prefix = "  " * indent
-    if caller:
-        prefix += caller.f_code.co_name
-        prefix += inspect.formatargvalues(*inspect.getargvalues(caller))
-        prefix += " "
-        del caller
+def error(msg):
+    raise RuntimeError(msg)
 
-    debug(level, prefix + msg)
+def internal_error(msg):
+    raise RuntimeError("stow.py internal error: " + msg)
 
 @contextmanager
 def cd(path):
@@ -88,34 +801,153 @@ def cd(path):
     os.chdir(old_dir)
     debug(3, "cwd restored to " + old_dir)
 
-class Stow:
+def rename_exchange(a, b):
+    """
+    Atomically swap the nodes at paths a and b using Linux's renameat2()
+    with RENAME_EXCHANGE.  Returns False if that is not available on this
+    platform, kernel or filesystem.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        import ctypes
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (ImportError, OSError, AttributeError):
+        return False
 
-    dotfiles = False
-    no_folding = False
-    ignores = []
-    defers = []
-    overrides = []
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 1 << 1
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b),
+                 RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err), a)
+
+def below_target(path):
+    """
+    Whether the normalized relative path names something strictly inside
+    the target, rather than the target itself or anything outside it
+    """
+    return not os.path.isabs(path) and path != os.curdir and \
+            path != os.pardir and not path.startswith(os.pardir + os.sep)
+
+def link_or_copy(src, dst):
+    """
+    copytree() helper which hard links files rather than copying them
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
 
-    action_count = 0
-    conflict_count = 0
+class Stow:
+    """
+    Plans and performs stow operations for one target directory.  All
+    state lives on the instance and every path is resolved against its own
+    target and stow directories rather than the process cwd, so several
+    instances may run at once in separate threads.
+    """
 
     def __repr__(self):
         return "Stow"
 
-    def __init__(self, target, dir=".", verbose=0, ignore=[], adopt=False):
+    def __init__(self, target, dir=".", verbose=0, ignore=(), defer=(),
+                 override=(), adopt=False, jobs=1, manifest=False, log=None,
+                 stats=False, record_reads=False, swap=None, index=None,
+                 scan_cache=False, check=False):
+        self.verbose = verbose
+        self.log = log
+        self.log_lock = threading.Lock()
         self.adopt=adopt
-        self.ignores = ignore
+        self.jobs = jobs
+        self.manifest = manifest
+        self.swap = swap and os.path.normpath(swap)
+        if self.swap and not below_target(self.swap):
+            error("cannot stage {}: it is not a subdirectory of the target"
+                  .format(swap))
+        # Only report conflicts, carrying on planning past them
+        self.check = check
+        self.dotfiles = False
+        self.no_folding = False
+        self.ignores = list(ignore)
+        self.ignore_res = combine_regexps(self.ignores)
+        self.package_ignores = {}
+        self.defers = list(defer)
+        self.overrides = list(override)
+        self.defer_res = combine_regexps(self.defers)
+        self.override_res = combine_regexps(self.overrides)
+        self.deferred = {}
+        self.overridden = {}
+        self.action_count = 0
+        self.conflict_count = 0
         self.target = target
         self.set_stow_dir(dir)
-        self.link_task_for = {}
-        self.dir_task_for = {}
-        self.tasks = []
+        # Recording the paths planning relies on lets write_plan()
+        # fingerprint them
+        self.planned = TaskTrie(reads=set() if record_reads else None)
+        self.tasks = TaskQueue()
+        # A Stats may be shared with the instances for other targets
+        self.stats = stats if isinstance(stats, Stats) else \
+                Stats() if stats else None
+        self.dirs = DirFds(target)
+        self.scan_cache = scan_cache
+        if scan_cache and index is None:
+            index = {}
+        self.fs = FsCache(self.dirs, self.stats, index, self.stow_path,
+                          self.read_scan_cache() if scan_cache else None,
+                          set() if record_reads else None)
+        self.markers = {}
+        self.owners = {}
+        self.manifest_events = []
+        self.snapshots = {}
         self.conflicts = {
             "stow": {},
             "unstow": {},
         }
-        global debug_level
-        debug_level = verbose
+
+    def debug(self, level, msg, *args):
+        """
+        Report msg if our verbosity is at least level.  msg is a format
+        string for args, and is only formatted when it is reported.
+        """
+        if self.verbose < level:
+            return
+        self.log_event(level, msg, args)
+
+    def debug_fn(self, level, msg = "", *args, **kwargs):
+        """
+        Like debug(), prefixed with the calling function and its arguments
+        """
+        if self.verbose < level:
+            return
+
+        caller = inspect.currentframe().f_back
+        fn = caller.f_code.co_name
+        fn += inspect.formatargvalues(*inspect.getargvalues(caller))
+        del caller
+        self.log_event(level, msg, args, fn=fn, indent=kwargs.get("indent", 0))
+
+    def log_event(self, level, msg, args, fn=None, indent=0):
+        """
+        Write out a debug message, as text or as a JSON line on self.log
+        """
+        text = msg.format(*args) if args else msg
+        if self.log is None:
+            if fn:
+                text = "  " * indent + fn + " " + text
+            report(text)
+            return
+
+        event = {"level": level, "event": msg, "message": text}
+        if args:
+            event["args"] = [str(arg) for arg in args]
+        if fn:
+            event["function"] = fn
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self.log_lock:
+            self.log.write(line)
 
     def set_stow_dir(self, dir):
         self.dir = dir
@@ -123,66 +955,532 @@ class Stow:
         stow_dir = os.path.realpath(dir)
         target = os.path.realpath(self.target)
         self.stow_path = os.path.relpath(stow_dir, target)
-
-        debug(2, "stow dir is " + stow_dir)
-        debug(2, "stow dir path relative to target {} is {}".format(
-            target, self.stow_path))
-
+        self.stow_dir = stow_dir
+        self.target_root = target
+        # Even without --manifest, changing the links of a package has to
+        # retire any manifest an earlier run left for it
+        self.track_links = self.manifest or \
+                os.path.isdir(os.path.join(stow_dir, ".stow-manifests"))
+
+        self.debug(2, "stow dir is {}", stow_dir)
+        self.debug(2, "stow dir path relative to target {} is {}",
+                target, self.stow_path)
+
+    @instrumented
     def package_path(self, package):
         path = join_paths(self.stow_path, package)
-        if not os.path.isdir(path):
+        if not self.fs.isdir(path):
             raise RuntimeError("The stow directory " + self.stow_path +
                     " does not contain package " + package)
         return path
 
     def plan_unstow(self, packages):
-        with cd(self.target):
-            for package in packages:
-                debug(2, "Planning unstow of package " + package + "...")
-                self.unstow_contents(self.stow_path, package, ".")
-                debug(2, "Planning unstow of package " + package + "... done")
-                self.action_count += 1
+        self.plan_packages("plan_unstow_package", packages)
 
     def plan_stow(self, packages):
-        with cd(self.target):
+        self.plan_packages("plan_stow_package", packages)
+
+    def plan_unstow_package(self, package):
+        self.debug(2, "Planning unstow of package {}...", package)
+        tree = self.manifest_tree(package) if self.manifest else None
+        if tree is not None:
+            self.debug(2, "Using the manifest of package {}", package)
+        self.unstow_contents(self.stow_path, package, ".", tree)
+        self.debug(2, "Planning unstow of package {}... done", package)
+        self.action_count += 1
+
+    def plan_stow_package(self, package):
+        self.debug(2, "Planning stow of package {}...", package)
+        if self.manifest:
+            # Walking the whole package records every link it owns
+            self.manifest_events.append((package, None, None))
+        path = self.package_path(package)
+        self.stow_contents(self.stow_path, package, ".", path)
+        if self.manifest:
+            self.snapshots[package] = self.scan_package(package)
+        self.debug(2, "Planning stow of package {}... done", package)
+        self.action_count += 1
+
+    def plan_restow(self, packages):
+        """
+        Restow packages.  A package whose manifest still agrees with the
+        target only has the nodes added to or removed from it since it was
+        last stowed planned; any other package is unstowed and stowed again.
+        """
+        rest = [package for package in packages
+                if not (self.manifest and
+                        self.plan_package("plan_restow_package", package))]
+        self.plan_unstow(rest)
+        self.plan_stow(rest)
+
+    def plan_restow_package(self, package):
+        record = self.read_manifest(package)
+        if record is None or "tree" not in record:
+            return False
+        # Links into removed package nodes are expected to dangle
+        for path, source in record["links"].items():
+            if not self.is_a_link(path) or self.read_a_link(path) != source:
+                self.debug(2, "Manifest of {} disagrees with {}", package, path)
+                return False
+
+        self.debug(2, "Planning incremental restow of package {}...", package)
+        snapshot = self.scan_package(package)
+        self.restow_contents(package, ".", record["tree"], snapshot,
+                record["links"])
+        self.snapshots[package] = snapshot
+        self.debug(2, "Planning incremental restow of package {}... done",
+                package)
+        self.action_count += 1
+        return True
+
+    @instrumented
+    def scan_package(self, package, target=".", path=None):
+        """
+        The nodes of package which stowing would consider, as a nested dict
+        mapping each name to its kind, or to the dict of its own nodes for
+        a directory
+        """
+        path = path or self.package_path(package)
+        tree = {}
+        for node, kind in self.fs.listdir(path):
+            node_target = join_paths(target, node)
+            if self.ignore(self.stow_path, package, node_target):
+                continue
+            if kind == "dir":
+                kind = self.scan_package(package, node_target,
+                        join_paths(path, node))
+            tree[node] = kind
+        return tree
+
+    def restow_contents(self, package, target, old, new, links):
+        """
+        Plan the difference between two snapshots of the package directory
+        at target.  Nodes which disappeared or changed kind lose every link
+        the manifest records at or below them, and nodes which appeared are
+        stowed.
+        """
+        def same_kind(a, b):
+            return a == b or isinstance(a, dict) and isinstance(b, dict)
+
+        for node, kind in old.items():
+            node_target = join_paths(target, node)
+            if node not in new or not same_kind(kind, new[node]):
+                self.debug(3, "Restow: {} was removed", node_target)
+                prefix = node_target + os.sep
+                for path in sorted(links):
+                    if path == node_target or path.startswith(prefix):
+                        self.do_unlink(path)
+            elif isinstance(kind, dict):
+                self.restow_contents(package, node_target, kind, new[node],
+                        links)
+
+        for node, kind in new.items():
+            if node not in old or not same_kind(kind, old[node]):
+                self.debug(3, "Restow: {} was added", join_paths(target, node))
+                self.restow_node(package, join_paths(target, node))
+
+    def restow_node(self, package, target):
+        """
+        Stow a node added to package, starting from the outermost directory
+        above it which stowing the whole package would not descend into;
+        a folded link there may already cover it.
+        """
+        parts = target.split(os.sep)
+        for depth in range(len(parts)):
+            node_target = os.path.join(*parts[:depth + 1])
+            if depth < len(parts) - 1 and not self.is_a_link(node_target) \
+                    and self.is_a_dir(node_target):
+                continue
+            source = join_paths(*([os.pardir] * depth +
+                    [self.stow_path, package, node_target]))
+            self.stow_node(self.stow_path, package, node_target, source)
+            return
+
+    def plan_dir_changes(self, package, dir, old):
+        """
+        Plan the nodes added to or removed from the package directory at
+        target dir since old, its snapshot from scan_package(), returning
+        its new snapshot.  Only dir itself is listed: subdirectories which
+        are still there keep their old snapshots.
+        """
+        path = join_paths(self.package_path(package), dir)
+        new = {}
+        for node, kind in self.fs.listdir(path) if self.fs.isdir(path) \
+                else ():
+            node_target = join_paths(dir, node)
+            if self.ignore(self.stow_path, package, node_target):
+                continue
+            if kind == "dir":
+                kind = old[node] if isinstance(old.get(node), dict) else \
+                        self.scan_package(package, node_target,
+                                join_paths(path, node))
+            new[node] = kind
+
+        def same_kind(a, b):
+            return a == b or isinstance(a, dict) and isinstance(b, dict)
+
+        for node, kind in old.items():
+            if node not in new or not same_kind(kind, new[node]):
+                self.debug(3, "Watch: {} was removed", join_paths(dir, node))
+                self.unstow_removed(package, join_paths(dir, node), kind)
+        for node, kind in new.items():
+            if node not in old or not same_kind(kind, old[node]):
+                self.debug(3, "Watch: {} was added", join_paths(dir, node))
+                self.restow_node(package, join_paths(dir, node))
+        return new
+
+    def unstow_removed(self, package, target, old):
+        """
+        Unstow a node which is no longer in package, given its last
+        snapshot.  The package directory cannot be walked any more, so the
+        links below target are found from the snapshot instead.
+        """
+        if self.is_a_link(target):
+            self.unstow_node(self.stow_path, package, target)
+        elif isinstance(old, dict) and self.is_a_dir(target):
+            for node, kind in old.items():
+                self.unstow_removed(package, join_paths(target, node), kind)
+            parent = self.foldable(target)
+            if parent:
+                self.fold_tree(target, parent)
+
+    def plan_packages(self, method, packages):
+        if self.jobs < 2 or len(packages) < 2:
             for package in packages:
-                debug(2, "Planning stow of package " + package + "...")
-                path = self.package_path(package)
-                self.stow_contents(self.stow_path, package, ".", path)
-                debug(2, "Planning stow of package " + package + "... done")
-                self.action_count += 1
+                self.plan_package(method, package)
+            return
+
+        # Plan every package speculatively against the filesystem alone
+        def speculate(package):
+            fork = self.fork()
+            try:
+                fork.plan_package(method, package)
+            except Exception as e:
+                return fork, e
+            return fork, None
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.jobs) as pool:
+            results = list(pool.map(speculate, packages))
+
+        # Merge in package order.  A speculative plan is only valid if
+        # it never looked at a path which an earlier package has tasks
+        # for (or below one); otherwise plan that package again against
+        # the merged tasks, exactly as serial planning would have.
+        for package, (fork, exc) in zip(packages, results):
+            if any(self.planned.touches(path) for path in fork.planned.reads):
+                self.debug(2, "Replanning package {} which overlaps earlier packages",
+                        package)
+                self.plan_package(method, package)
+                continue
+
+            self.merge(fork)
+            if exc:
+                raise exc
+
+    def claimed_names(self, method, package):
+        """
+        The top-level target names which planning package with method may
+        touch: those of its nodes and, when unstowing from a manifest, of
+        the links it records
+        """
+        names = set()
+        for node, _ in self.fs.listdir(self.package_path(package)):
+            if not self.ignore(self.stow_path, package, node):
+                names.add(node)
+        if self.manifest and method != "plan_stow_package":
+            record = self.read_manifest(package)
+            if record:
+                names.update(path.split(os.sep)[0] for path in record["links"])
+        return names
+
+    def stream_tasks(self, steps):
+        """
+        Plan steps, (method, package) pairs for plan_package(), in order,
+        yielding each task once it is final.  Every task lies below the
+        top-level name of a node of the package which planned it, so once
+        no step still to come claims that name, no later step can revert
+        or reorder it.  Only tasks below names claimed by the steps to
+        come are kept, along with their trie.
+        """
+        claims = {}
+        step_names = []
+        for method, package in steps:
+            names = self.claimed_names(method, package)
+            for name in names:
+                claims[name] = claims.get(name, 0) + 1
+            step_names.append(names)
+
+        for (method, package), names in zip(steps, step_names):
+            self.plan_package(method, package)
+            for name in names:
+                claims[name] -= 1
+            freed = set()
+            for task in list(self.tasks):
+                name = task.path.split(os.sep, 1)[0]
+                if not claims.get(name):
+                    self.tasks.remove(task)
+                    freed.add(name)
+                    yield task
+            for name in freed:
+                self.planned.prune(name)
+
+    def process_streaming(self, steps, backlog=1024):
+        """
+        Plan steps with stream_tasks() while a worker thread makes each
+        final task, holding at most backlog of them in between.  Unlike
+        process_tasks(), a conflict found part way leaves the changes
+        already made for earlier packages in place.
+        """
+        import queue
+        pending = queue.Queue(backlog)
+        failed = []
+
+        def work():
+            while True:
+                task = pending.get()
+                if task is None:
+                    return
+                # Keep draining after a failure so the planner never blocks
+                if not failed:
+                    try:
+                        self.process_task(task)
+                    except Exception as e:
+                        failed.append(e)
+
+        worker = threading.Thread(target=work)
+        worker.start()
+        try:
+            with self.timed("stream"):
+                for task in self.stream_tasks(steps):
+                    if failed:
+                        break
+                    pending.put(task)
+        finally:
+            pending.put(None)
+            worker.join()
+        if failed:
+            raise failed[0]
+
+        self.fs.clear()
+        self.dirs.close()
+        # Leaves only the manifests and stats to process_tasks()
+        self.process_tasks()
+
+    def plan_package(self, method, package):
+        """
+        Plan package with the given plan_*_package method, timing it
+        """
+        action = method[len("plan_"):-len("_package")]
+        with self.timed("plan", action=action, package=package):
+            return getattr(self, method)(package)
+
+    def timed(self, phase, **labels):
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.timed(phase, **labels)
+
+    def count_task(self, type, outcome):
+        """
+        Count a task queued, or one which duplicates or reverts a task
+        already queued
+        """
+        if self.stats:
+            self.stats.add("tasks", type=type, outcome=outcome)
+
+    def count_cache(self):
+        """
+        Move the hits and misses of our filesystem cache so far into stats
+        """
+        if self.stats:
+            self.stats.add("fs_cache_hits", self.fs.hits)
+            self.stats.add("fs_cache_misses", self.fs.misses)
+            self.fs.hits = self.fs.misses = 0
+
+    def fork(self):
+        """
+        Create a planner sharing our configuration and filesystem caches
+        but with an empty task queue which records every path it reads
+        """
+        fork = copy.copy(self)
+        fork.planned = TaskTrie(reads=set())
+        fork.tasks = TaskQueue()
+        fork.manifest_events = []
+        fork.snapshots = {}
+        fork.conflicts = {
+            "stow": {},
+            "unstow": {},
+        }
+        fork.action_count = 0
+        fork.conflict_count = 0
+        return fork
+
+    def merge(self, fork):
+        """
+        Append the tasks and conflicts planned by a fork
+        """
+        for task in fork.tasks:
+            self.tasks.append(task)
+            if task.type == "link":
+                self.planned.node(task.path).link = task
+            elif task.type == "dir":
+                self.planned.node(task.path).dir = task
+
+        if self.planned.reads is not None:
+            self.planned.reads.update(fork.planned.reads)
+        self.manifest_events.extend(fork.manifest_events)
+        self.snapshots.update(fork.snapshots)
+        for action, packages in fork.conflicts.items():
+            for package, messages in packages.items():
+                self.conflicts[action].setdefault(package, []).extend(messages)
+        self.action_count += fork.action_count
+        self.conflict_count += fork.conflict_count
 
     def process_tasks(self):
-        debug(2, "Processing tasks...")
+        self.debug(2, "Processing tasks...")
+        self.count_cache()
+
+        with self.timed("process"):
+            if self.tasks:
+                if self.swap and self.can_swap():
+                    self.process_tasks_swapped()
+                else:
+                    self.run_tasks(list(self.tasks))
+            # The filesystem may no longer match what we cached while
+            # planning, and a run with nothing to do has no further use
+            # for the descriptors it holds
+            self.fs.clear()
+            self.dirs.close()
+
+            if self.manifest:
+                self.write_manifests()
+                self.markers.clear()
+                self.owners.clear()
+            elif self.manifest_events:
+                self.drop_manifests()
+            if self.fs.rescanned:
+                self.write_scan_cache()
+
+        self.debug(2, "Processing tasks... done")
+
+    def run_tasks(self, tasks):
+        if self.jobs > 1 and len(tasks) > 1:
+            self.process_tasks_in_parallel(tasks)
+        else:
+            for task in tasks:
+                self.process_task(task)
 
-        # Strip out all tasks with a skip action
-        self.tasks = [x for x in self.tasks if x.action != "skip"]
+    def can_swap(self):
+        """
+        Whether the tasks can be staged for self.swap: it has to be a real
+        directory which none of them replace
+        """
+        for task in self.tasks:
+            if task.path == self.swap or \
+                    self.swap.startswith(task.path + os.sep):
+                warn("not staging {}: it is changed by the plan itself".
+                        format(self.swap))
+                return False
+        if not self.fs.isdir(self.swap) or self.fs.islink(self.swap):
+            warn("not staging {}: it is not a directory".format(self.swap))
+            return False
+        return True
 
-        if self.tasks:
-            with cd(self.target):
-                for task in self.tasks:
-                    self.process_task(task)
+    def process_tasks_swapped(self):
+        """
+        Carry out the tasks below self.swap on a copy of it, made in a
+        staging directory beside it, then swap the copy in.  The live
+        directory goes straight from its old to its new contents, with
+        renameat2(RENAME_EXCHANGE) where possible and otherwise two
+        renames.  Anything created in the live directory by someone else
+        between staging and swapping is lost along with the old copy.
+        """
+        swap = self.swap
+        stage = os.path.join(os.path.dirname(swap),
+                             "." + os.path.basename(swap) + ".stow-stage")
+        prefix = swap + os.sep
+        inside = [task for task in self.tasks if task.path.startswith(prefix)]
+        self.run_tasks([task for task in self.tasks
+                        if not task.path.startswith(prefix)])
+
+        live = os.path.join(self.dirs.root, swap)
+        staged = os.path.join(self.dirs.root, stage)
+        if os.path.lexists(staged):
+            shutil.rmtree(staged)
+        self.debug(2, "Staging {} in {}", swap, stage)
+        shutil.copytree(live, staged, symlinks=True,
+                        copy_function=link_or_copy)
+
+        # Links are relative to their own dir, so they are the same in the
+        # stage, which sits at the same depth as the live dir
+        def staged_task(task):
+            task = copy.copy(task)
+            task.path = stage + task.path[len(swap):]
+            return task
+        self.run_tasks([staged_task(task) for task in inside])
+        self.dirs.close()
+
+        if rename_exchange(staged, live):
+            self.debug(2, "Swapped {} into place", stage)
+            old = staged
+        else:
+            old = os.path.join(self.dirs.root, stage + ".old")
+            self.debug(2, "Renaming {} into place", stage)
+            os.rename(live, old)
+            os.rename(staged, live)
+        shutil.rmtree(old)
 
-        debug(2, "Processing tasks... done")
+    def process_tasks_in_parallel(self, tasks):
+        """
+        Run tasks on a pool of self.jobs threads, starting each task as
+        soon as every task it depends on has completed
+        """
+        deps = task_dependencies(tasks)
+        waiting = [len(before) for before in deps]
+        dependents = [[] for _ in tasks]
+        for i, before in enumerate(deps):
+            for j in before:
+                dependents[j].append(i)
+
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        with ThreadPoolExecutor(self.jobs) as pool:
+            running = {}
+            def start(i):
+                running[pool.submit(self.process_task, tasks[i])] = i
+
+            for i, count in enumerate(waiting):
+                if not count:
+                    start(i)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    # Stop scheduling on the first failure; leaving the
+                    # with block waits for the tasks still running
+                    future.result()
+                    for j in dependents[i]:
+                        waiting[j] -= 1
+                        if not waiting[j]:
+                            start(j)
 
     def process_task(self, task):
         if task.action == "create":
             if task.type == "dir":
-                os.mkdir(task.path)
+                self.dirs.mkdir(task.path)
                 return
             elif task.type == "link":
-                os.symlink(task.source, task.path)
+                self.dirs.symlink(task.source, task.path)
                 return
         elif task.action == "remove":
             if task.type == "dir":
-                os.rmdir(task.path)
+                self.dirs.rmdir(task.path)
                 return
             elif task.type == "link":
-                os.unlink(task.path)
+                self.dirs.unlink(task.path)
                 return
         elif task.action == "move":
             if task.type == "file":
-                os.rename(task.path, task.dest)
+                self.dirs.rename(task.path, task.dest)
                 return
 
         raise RuntimeError("bad task: " + task)
@@ -191,87 +1489,89 @@ class Stow:
         """
         Determine if the given path matches a regex in our defer list
         """
-        return any(exp.search(path) for exp in self.defers)
+        return self.search_cached(self.defer_res, self.deferred, path)
 
     def override(self, path):
         """
         Determine if the given path matches a regex in our override list
         """
-        return any(exp.search(path) for exp in self.overrides)
+        return self.search_cached(self.override_res, self.overridden, path)
 
-    def parent_link_scheduled_for_removal(self, path):
-        prefix = ""
-        for part in path.split(os.sep):
-            prefix = os.path.join(prefix, part)
-            debug_fn(4, "prefix " + prefix, indent=2)
-            if self.link_task_for.get(prefix) == "remove":
-                debug_fn(4, "link scheduled for removal", indent=2)
-                return True
+    def search_cached(self, regexps, cache, path):
+        """
+        Determine if path matches any of regexps, remembering the answer
+        in cache since the same path conflicts once for every package
+        which provides it
+        """
+        if not regexps:
+            return False
+        found = cache.get(path)
+        if found is None:
+            found = cache[path] = any(exp.search(path) for exp in regexps)
+        return found
 
-        debug_fn(4, "returning False", indent=2)
-        return False
+    def parent_link_scheduled_for_removal(self, path):
+        _, _, removed = self.planned.lookup(path)
+        self.debug_fn(4, "returning {}", removed, indent=2)
+        return removed
 
+    @instrumented
     def is_a_link(self, path):
-        debug_fn(4, indent=1)
+        self.debug_fn(4, indent=1)
 
-        try:
-            action = self.link_task_for[path].action
-            if action == "remove":
-                debug_fn(4, "returning False (remove action found)")
+        link_task, _, parent_removed = self.planned.lookup(path)
+        if link_task is not None:
+            if link_task.action == "remove":
+                self.debug_fn(4, "returning False (remove action found)")
                 return False
-            elif action == "create":
-                debug_fn(4, "returning True (create action found)")
+            elif link_task.action == "create":
+                self.debug_fn(4, "returning True (create action found)")
                 return True
-        except KeyError:
-            pass
 
-        if os.path.islink(path):
-            # Check if any of its parents are links scheduled for removal
-            # (need this for edge case during unfolding)
-            debug_fn(4, "is a real link")
-            return not self.parent_link_scheduled_for_removal(path)
+        # Check if any of its parents are links scheduled for removal
+        # (need this for edge case during unfolding) before looking
+        # through them
+        if not parent_removed and self.fs.islink(path):
+            self.debug_fn(4, "is a real link")
+            return True
 
-        debug_fn(4, "returning False")
+        self.debug_fn(4, "returning False")
         return False
 
+    @instrumented
     def read_a_link(self, path):
-        try:
-            action = self.link_task_for[path].action
-            debug_fn(4, "task exists with action " + action, indent=1)
+        link_task = self.planned.link(path)
+        if link_task is not None:
+            action = link_task.action
+            self.debug_fn(4, "task exists with action {}", action, indent=1)
             if action == "create":
-                return self.link_task_for[path].source
+                return link_task.source
             elif action == "remove":
                 raise RuntimeError("read_a_link() passed a path scheduled for removal: " + path)
-        except KeyError:
-            pass
 
-        if os.path.islink(path):
-            debug_fn(4, "real link", indent=1)
-            return os.readlink(path)
+        if self.fs.islink(path):
+            self.debug_fn(4, "real link", indent=1)
+            return self.fs.readlink(path)
 
         raise RuntimeError("read_a_link() passed a non link path: " + path)
 
+    @instrumented
     def find_stowed_path(self, target, source):
         # Evaluate softlink relative to its target
         path = join_paths(target, os.pardir, source)
-        debug(4, "  is path " + path + " owned by stow?")
+        self.debug(4, "  is path {} owned by stow?", path)
 
         # Search for .stow files - this allows us to detect links
         # owned by stow directories other than the current one
-        dir = ""
-        pathparts = path.split(os.sep)
-        for i in range(len(pathparts)):
-            part = pathparts[i]
-            dir = os.path.join(dir, part)
-            if self.marked_stow_dir(dir):
-                # FIXME - not sure if this can ever happen
-                if i + 1 == len(path):
-                    internal_error(
-                            "find_stowed_path() called directly on stow dir")
-
-                debug(4, "    yes - " + dir + " was marked as a stow dir")
-                package = pathparts[i + 1]
-                return path, dir, package
+        owner = self.stow_dir_owning(os.path.dirname(path))
+        if owner:
+            dir, package = owner
+            self.debug(4, "    yes - {} was marked as a stow dir", dir)
+            return path, dir, package or os.path.basename(path)
+
+        # FIXME - not sure if this can ever happen
+        if self.marked_stow_dir(path):
+            internal_error("find_stowed_path() called directly on stow dir")
 
         # If no .stow file was found, we need to find out whether it's
         # owned by the current stow directory, in which case the path will be
@@ -281,64 +1581,57 @@ class Stow:
             warn("BUG in find_stowed_path? Absolute/relative mismatch between "
                     "Stow dir " + self.stow_path + " and path " + path)
 
-        stow_path = self.stow_path.split(os.sep)
-
-        # Strip off common prefixes until one is empty
-        while path and stow_path:
-            if pathparts.pop(0) != stow_path.pop(0):
-                debug(4, "    no - either " + path + " not under " +
-                        self.stow_path + " or vice-versa")
-                return "", "", ""
-
-        if stow_path: # path list must be empty
-            debug(4, "    no - " + path + " is not under " + self.stow_path)
+        prefix = self.stow_path + os.sep
+        if not path.startswith(prefix):
+            self.debug(4, "    no - {} is not under {}", path, self.stow_path)
             return "", "", ""
 
-        package = pathparts.pop(0)
-        debug(4, "    yes - by " + package + " in " + os.path.join(*pathparts))
+        package = path[len(prefix):].split(os.sep, 1)[0]
+        self.debug(4, "    yes - by {} in {}", package, self.stow_path)
         return path, self.stow_path, package
 
     def conflict(self, action, package, message):
-        debug(2, "CONFLICT when {}ing {}: {}".format(action, package, message))
+        self.debug(2, "CONFLICT when {}ing {}: {}", action, package, message)
         self.conflicts[action].setdefault(package, []).append(message)
         self.conflict_count += 1
-        raise RuntimeError(message)
+        if not self.check:
+            raise RuntimeError(message)
 
+    @instrumented
     def is_a_dir(self, path):
-        debug_fn(4)
+        self.debug_fn(4)
 
-        try:
-            action = self.link_task_for[path].action
-            if action == "remove":
+        _, dir_task, parent_removed = self.planned.lookup(path)
+        if dir_task is not None:
+            if dir_task.action == "remove":
                 return False
-            elif action == "create":
+            elif dir_task.action == "create":
                 return True
-        except KeyError:
-            pass
 
-        if self.parent_link_scheduled_for_removal(path):
+        if parent_removed:
             return False
 
-        if os.path.isdir(path):
-            debug_fn(4, "real dir")
+        if self.fs.isdir(path):
+            self.debug_fn(4, "real dir")
             return True
 
-        debug_fn(4, "returning False")
+        self.debug_fn(4, "returning False")
         return False
 
+    @instrumented
     def stow_node(self, stow_path, package, target, source):
 
         path = join_paths(stow_path, package, target)
 
-        debug(3, "Stowing {} / {} / {}".format(stow_path, package, target))
-        debug(4, "  => " + source)
+        self.debug(3, "Stowing {} / {} / {}", stow_path, package, target)
+        self.debug(4, "  => {}", source)
 
         # Don't try to stow absolute symlinks (they can't be unstowed)
-        if os.path.islink(source) and os.path.isabs(self.read_a_link(source)):
+        if self.fs.islink(path) and os.path.isabs(self.fs.readlink(path)):
             self.conflict("stow", package,
                     "source is an absolute symlink {} => {}".\
-                            format(source, second_source))
-            debug(3, "Absolute symlinks cannot be unstowed")
+                            format(source, self.fs.readlink(path)))
+            self.debug(3, "Absolute symlinks cannot be unstowed")
             return
 
         # Does the target already exist?
@@ -346,8 +1639,8 @@ class Stow:
             existing_source = self.read_a_link(target)
             if not existing_source:
                 error("Could not read link: " + target)
-            debug(4, "Evaluate existing link: {} => {}".format(
-                        target, existing_source))
+            self.debug(4, "Evaluate existing link: {} => {}",
+                    target, existing_source)
 
             # Does it point to a node under any stow directory?
             existing_path, existing_stow_path, existing_package = \
@@ -361,12 +1654,14 @@ class Stow:
             # Does the existing target actually point to anything?
             if self.is_a_node(existing_path):
                 if existing_source == source:
-                    debug(2, "--- Skipping {} as it already points to {}".
-                            format(target, source))
+                    self.debug(2, "--- Skipping {} as it already points to {}",
+                            target, source)
+                    if self.manifest:
+                        self.record_link(target, source)
                 elif self.defer(target):
-                    debug(2, "--- Deferring installation of " + target)
+                    self.debug(2, "--- Deferring installation of {}", target)
                 elif self.override(target):
-                    debug(2, "--- Overriding installation of " + target)
+                    self.debug(2, "--- Overriding installation of {}", target)
                     self.do_unlink(target)
                     self.do_link(source, target)
                 elif self.is_a_dir(join_paths(target, os.pardir, source)) and \
@@ -376,11 +1671,11 @@ class Stow:
                     # and the proposed new link points to a directory,
                     # then we can unfold (split open) the tree at that point
 
-                    debug(2, "--- Unfolding {} which was already owned by {}".
-                        format(target, existing_package))
+                    self.debug(2, "--- Unfolding {} which was already owned by {}",
+                            target, existing_package)
                     self.do_unlink(target)
                     self.do_mkdir(target)
-                    self.stow_contents(
+                    self.unfold_contents(
                         existing_stow_path,
                         existing_package,
                         target,
@@ -398,11 +1693,11 @@ class Stow:
                         "{} => {}".format(target, existing_source))
             else:
                 # The existing link is invalid, so replace it with a good link
-                debug(2, "--- replacing invalid link: " + path)
+                self.debug(2, "--- replacing invalid link: {}", path)
                 self.do_unlink(target)
                 self.do_link(source, target)
         elif self.is_a_node(target):
-            debug(4, "Evaluate existing node: " + target)
+            self.debug(4, "Evaluate existing node: {}", target)
             if self.is_a_dir(target):
                 self.stow_contents(self.stow_path, package, target,
                     os.path.join(os.pardir, source))
@@ -414,23 +1709,29 @@ class Stow:
                     self.conflict("stow", package,
                         "existing target is neither a link nor a dir: " +
                         target)
-        elif self.no_folding and os.path.isdir(path) and \
-             not os.path.islink(path):
+        elif self.no_folding and self.fs.isdir(path) and \
+             not self.fs.islink(path):
             self.do_mkdir(target)
             self.stow_contents(self.stow_path, package, target,
                 os.path.join(os.pardir, source))
         else:
             self.do_link(source, target)
 
-    def unstow_node(self, stow_path, package, target):
+    @instrumented
+    def unstow_node(self, stow_path, package, target, tree=None):
+        """
+        Plan the unstow of one node, returning what is left at target
+        afterwards for foldable(): the source of a link, False for
+        anything else, or None for nothing
+        """
         path = join_paths(stow_path, package, target)
 
-        debug(3, "Unstowing " + path)
-        debug(4, "  target is " + target)
+        self.debug(3, "Unstowing {}", path)
+        self.debug(4, "  target is {}", target)
 
         # Does the target exist?
         if self.is_a_link(target):
-            debug(4, "  Evaluating existing link: " + target)
+            self.debug(4, "  Evaluating existing link: {}", target)
 
             # Where is the link pointing?
             existing_source = self.read_a_link(target)
@@ -440,7 +1741,7 @@ class Stow:
             if os.path.isabs(existing_source):
                 warn("Ignoring an absolute symlink: " + target +
                         " => " + existing_source)
-                return
+                return existing_source
 
             # Does it point to a node under any stow directory?
             existing_path, existing_stow_path, existing_package = \
@@ -449,10 +1750,10 @@ class Stow:
                 self.conflict("unstow", package,
                         "existing target is not owned by stow: " + target +
                         " => " + existing_source)
-                return
+                return existing_source
 
             # Does the existing target actually point to anything?
-            if os.path.exists(existing_path):
+            if self.fs.exists(existing_path):
                 # Does the link point to the right place?
 
                 # Adjust for dotfile if necessary.
@@ -461,15 +1762,16 @@ class Stow:
 
                 if existing_path == path:
                     self.do_unlink(target)
+                    return None
 
                 # XXX we quietly ignore links that are stowed to a different
                 # package.
 
                 #elsif (defer($target)) {
-                #    debug(2, "--- deferring to installation of: $target");
+                #    self.debug(2, "--- deferring to installation of: $target");
                 #}
                 #elsif ($self->override($target)) {
-                #    debug(2, "--- overriding installation of: $target");
+                #    self.debug(2, "--- overriding installation of: $target");
                 #    $self->do_unlink($target);
                 #}
                 #else {
@@ -482,22 +1784,27 @@ class Stow:
                 #}
 
             else:
-                debug(2, "--- removing invalid link into a stow dir: " + path)
+                self.debug(2, "--- removing invalid link into a stow dir: {}",
+                        path)
                 self.do_unlink(target)
-        elif os.path.exists(target):
-            debug(4, "  Evaluate existing node: " + target)
-            if os.path.isdir(target):
-                self.unstow_contents(stow_path, package, target)
+                return None
+            return existing_source
+        elif self.fs.exists(target):
+            self.debug(4, "  Evaluate existing node: {}", target)
+            if self.fs.isdir(target):
+                left = self.unstow_contents(stow_path, package, target, tree)
 
                 # This action may have made the parent directory foldable
-                parent = self.foldable(target)
+                parent = self.foldable(target, left)
                 if parent:
                     self.fold_tree(target, parent)
+                    return parent
             else:
                 self.conflict("unstow", package, "existing target is neither "
                         "a link nor a dir: " + target)
+            return False
         else:
-            debug(2, target + " did not exist to be unstowed")
+            self.debug(2, "{} did not exist to be unstowed", target)
 
 
     def should_skip_target_which_is_stow_dir(self, target):
@@ -508,16 +1815,54 @@ class Stow:
             warn("skipping protected directory " + target)
             return True
 
-        debug(4, target + " not protected")
+        self.debug(4, "{} not protected", target)
         return False
 
+    @instrumented
     def marked_stow_dir(self, target):
+        try:
+            return self.markers[target]
+        except KeyError:
+            pass
+
+        marked = False
         for f in (".stow", ".nonstow"):
-            if os.path.exists(os.path.join(target, f)):
-                debug(4, target + " contained " + f)
-                return True
-        return False
+            if self.fs.exists(join_paths(target, f)):
+                self.debug(4, "{} contained {}", target, f)
+                marked = True
+                break
+        self.markers[target] = marked
+        return marked
+
+    @instrumented
+    def stow_dir_owning(self, dir):
+        """
+        Find the nearest marked stow directory at or above dir.
+        Returns (stow dir, package), with package None when dir is the
+        stow dir itself, or None if no ancestor is marked.  Answers are
+        memoized per directory, so links into the same package share
+        the marker probes of their common prefix.
+        """
+        if not dir:
+            return None
+        try:
+            return self.owners[dir]
+        except KeyError:
+            pass
+
+        parent = os.path.dirname(dir)
+        owner = self.stow_dir_owning(parent) if parent != dir else None
+        if owner:
+            stow_dir, package = owner
+            if package is None:
+                owner = (stow_dir, os.path.basename(dir))
+        elif self.marked_stow_dir(dir):
+            owner = (dir, None)
+
+        self.owners[dir] = owner
+        return owner
 
+    @instrumented
     def stow_contents(self, stow_path, package, target, source):
         """
         stow the contents of the given directory
@@ -541,75 +1886,155 @@ class Stow:
         if self.should_skip_target_which_is_stow_dir(target):
             return
 
-        msg = "Stowing contents of {} (cwd={})".format(path, os.getcwd())
-        msg = msg.replace(os.environ["HOME"], "~")
-        debug(3, msg)
-        debug(4, "  => " + source)
+        if self.verbose >= 3:
+            msg = "Stowing contents of {} (target={})".format(path, self.target)
+            self.debug(3, msg.replace(os.environ["HOME"], "~"))
+        self.debug(4, "  => {}", source)
 
-        if not os.path.isdir(path):
+        if not self.fs.isdir(path):
             raise RuntimeError("called with non-directory path: " + path)
         if not self.is_a_node(target):
             raise RuntimeError("called with non-directory target: " + target)
 
-        for node in os.listdir(path):
+        # One listing answers the lstat question for every child, unless
+        # target is a directory still to be created, such as one being
+        # unfolded, which has nothing in it to ask about
+        dir_task = self.planned.dir(target)
+        if self.fs.isdir(target) and \
+                not (dir_task and dir_task.action == "create"):
+            self.fs.listdir(target)
+
+        for node, _ in self.fs.listdir(path):
             node_target = join_paths(target, node)
             if self.ignore(stow_path, package, node_target):
                 continue
 
             if self.dotfiles:
                 adj_node_target = adjust_dotfile(node_target)
-                debug(4, "  Adjusting: " + node_target + " => " + adj_node_target)
+                self.debug(4, "  Adjusting: {} => {}",
+                        node_target, adj_node_target)
                 node_target = adj_node_target
 
             self.stow_node(stow_path, package, node_target,
                     join_paths(source, node))
 
-    def unstow_contents(self, stow_path, package, target):
+    @instrumented
+    def unfold_contents(self, stow_path, package, target, source):
+        """
+        Relink the contents of a directory which was folded to package,
+        into target which is being unfolded from that link.  target has
+        nothing in it yet, so unlike stow_contents() nothing there needs
+        checking and most nodes are linked straight from the package
+        listing.
+        """
+        if self.should_skip_target_which_is_stow_dir(target):
+            return
+        if self.dotfiles:
+            self.stow_contents(stow_path, package, target, source)
+            return
+
+        path = join_paths(stow_path, package, target)
+        self.debug(3, "Relinking contents of {} into {}", path, target)
+        for node, kind in self.fs.listdir(path):
+            node_target = join_paths(target, node)
+            if self.ignore(stow_path, package, node_target):
+                continue
+            node_source = join_paths(source, node)
+            # Absolute links conflict, and --no-folding recreates dirs
+            if kind == "link" or kind == "dir" and self.no_folding:
+                self.stow_node(stow_path, package, node_target, node_source)
+            else:
+                self.do_link(node_source, node_target)
+
+    @instrumented
+    def unstow_contents(self, stow_path, package, target, tree=None):
+        """
+        unstow the contents of the given directory.  tree optionally
+        limits this to the nodes recorded in the package manifest (see
+        manifest_tree()) instead of everything in the package directory.
+        Returns what unstow_node() left at each node it visited.
+        """
         path = join_paths(stow_path, package, target)
 
         if self.should_skip_target_which_is_stow_dir(target):
-            return
+            return {}
 
-        msg = "Unstowing from target (cwd=" + os.getcwd() + ", stow_dir=" + \
-            self.stow_path
-        msg = msg.replace(os.environ["HOME"], "~")
-        debug(3, msg)
-        debug(4, "  source path is " + path)
+        if self.verbose >= 3:
+            msg = "Unstowing from target (target=" + self.target + \
+                ", stow_dir=" + self.stow_path
+            self.debug(3, msg.replace(os.environ["HOME"], "~"))
+        self.debug(4, "  source path is {}", path)
         # We traverse the source tree, not the target tree, so path must exist
-        if not os.path.isdir(path):
+        if not self.fs.isdir(path):
             error("unstow_contents() called with non-directory path:" + path)
         # When called at the top level, target should exist. And unstow_node()
         # should only call this via mutual recursiion if target exists.
         if not self.is_a_node(target):
             error("unstow_contents() called with invalid target:" + target)
 
-        for node in os.listdir(path):
+        if tree is not None:
+            nodes = tree.items()
+        else:
+            if self.fs.isdir(target):
+                # One listing answers the lstat question for every child
+                self.fs.listdir(target)
+            nodes = [(node, None) for node, _ in self.fs.listdir(path)]
+
+        left = {}
+        for node, subtree in nodes:
             node_target = join_paths(target, node)
             if self.ignore(stow_path, package, node_target):
                 continue
 
-            if self.dotfiles:
+            # Manifests already record adjusted target names
+            if self.dotfiles and tree is None:
                 adj_node_target = adjust_dotfile(node_target)
-                debug(4, "  Adjusting: " + node_target + " => " + adj_node_target)
+                self.debug(4, "  Adjusting: {} => {}",
+                        node_target, adj_node_target)
                 node_target = adj_node_target
 
-            self.unstow_node(stow_path, package, node_target)
+            left[os.path.basename(node_target)] = \
+                    self.unstow_node(stow_path, package, node_target, subtree)
+        return left
 
     def ignore(self, stow_path, package, target):
         if len(target) == 0:
             raise RuntimeError("ignore() called with empty target")
 
-        for suffix in self.ignores:
+        for suffix in self.ignore_res:
             if suffix.match(target):
-                debug(4, "  Ignoring path " + target + " due to --ignore=" +
-                        str(suffix))
+                self.debug(4, "  Ignoring path {} due to --ignore", target)
                 return True
 
-        # TODO match ignore regexps
+        if self.ignores_for(stow_path, package).match(target):
+            self.debug(4, "  Ignoring path {} due to ignore list", target)
+            return True
 
-        debug(5, "  Not ignoring " + target)
+        self.debug(5, "  Not ignoring {}", target)
         return False
 
+    def ignores_for(self, stow_path, package):
+        """
+        The ignore list of a package: its .stow-local-ignore, or else
+        ~/.stow-global-ignore, or else the built-in defaults.  Each is only
+        read once.
+        """
+        key = (stow_path, package)
+        ignores = self.package_ignores.get(key)
+        if ignores is None:
+            patterns = Ignores.read(
+                    os.path.join(self.target_root, stow_path, package,
+                                 ".stow-local-ignore"))
+            if patterns is None:
+                patterns = Ignores.read(
+                        os.path.join(os.path.expanduser("~"),
+                                     ".stow-global-ignore"))
+            if patterns is None:
+                patterns = Ignores.defaults
+            ignores = self.package_ignores[key] = Ignores(patterns)
+        return ignores
+
+    @instrumented
     def is_a_node(self, path):
         """
         Determine whether the given path is a current or planned node
@@ -617,16 +2042,11 @@ class Stow:
         true if a non-existent node is scheduled for creation
         we also need to be sure we are not just following a link
         """
-        debug_fn(4, indent=1)
+        self.debug_fn(4, indent=1)
 
-        try:
-            laction = self.link_task_for[path].action
-        except KeyError:
-            laction = ""
-        try:
-            daction = self.dir_task_for[path].action
-        except KeyError:
-            daction = ""
+        link_task, dir_task, parent_removed = self.planned.lookup(path)
+        laction = link_task.action if link_task else ""
+        daction = dir_task.action if dir_task else ""
 
         if laction == "remove":
             if daction == "remove":
@@ -659,20 +2079,24 @@ class Stow:
             else: # no dir action
                 pass # fall through to below
 
-        if self.parent_link_scheduled_for_removal(path):
+        if parent_removed:
             return False
 
-        if os.path.exists(path):
-            debug_fn(4, "really exists", indent=1)
+        if self.fs.exists(path):
+            self.debug_fn(4, "really exists", indent=1)
             return True
 
-        debug_fn(4, "returning False")
+        self.debug_fn(4, "returning False")
         return False
 
     def do_link(self, oldfile, newfile):
+        if self.track_links:
+            self.record_link(newfile, oldfile)
+
+        node = self.planned.node(newfile)
 
-        if newfile in self.dir_task_for:
-            task_ref = self.dir_task_for[newfile]
+        if node.dir is not None:
+            task_ref = node.dir
             if task_ref.action == "create":
                 if task_ref.type == "dir":
                     internal_error("new link ({} => {}) clashes with planned "
@@ -683,27 +2107,30 @@ class Stow:
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        if newfile in self.link_task_for:
-            task_ref = self.link_task_for[newfile]
+        if node.link is not None:
+            task_ref = node.link
             if task_ref.action == "create":
                 if task_ref.source != oldfile:
                     internal_error("new link clashes with planned new link: "
                             "{} => {}".format(task_ref.path, task_ref.source))
                 else:
-                    debug(1, "LINK: {} => {} (duplicates previous action)"\
-                            .format(newfile, oldfile))
+                    self.debug(1, "LINK: {} => {} (duplicates previous action)",
+                            newfile, oldfile)
+                    self.count_task("link", "duplicate")
                     return
             elif task_ref.action == "remove":
                 if task_ref.source == oldfile:
-                    debug(1, "LINK: " + newfile + " => " + oldfile +
-                            " (reverts previous action)")
-                    self.link_task_for[newfile].action = "skip"
-                    del self.link_task_for[newfile]
+                    self.debug(1, "LINK: {} => {} (reverts previous action)",
+                            newfile, oldfile)
+                    self.tasks.remove(node.link)
+                    node.link = None
+                    self.count_task("link", "reverted")
                     return
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        debug(1, "LINK: " + newfile + " => " + oldfile)
+        self.debug(1, "LINK: {} => {}", newfile, oldfile)
+        self.count_task("link", "queued")
         task = Task.Link(
             action = "create",
             type = "link",
@@ -711,29 +2138,38 @@ class Stow:
             source = oldfile,
         )
         self.tasks.append(task)
-        self.link_task_for[newfile] = task
+        node.link = task
 
     def do_unlink(self, file):
-        if file in self.link_task_for:
-            task_ref = self.link_task_for[file]
+        if self.track_links:
+            link_task = self.planned.link(file)
+            self.record_link(file, None, link_task.source if link_task
+                    else self.fs.readlink(file))
+
+        node = self.planned.node(file)
+
+        if node.link is not None:
+            task_ref = node.link
             if task_ref.action == "remove":
-                debug(1, "UNLINK: " + file + " (duplicates previous action)")
+                self.debug(1, "UNLINK: {} (duplicates previous action)", file)
+                self.count_task("unlink", "duplicate")
                 return
             elif task_ref.action == "create":
-                self.link_task_for[file].action = "skip"
-                del self.link_task_for[file]
+                self.tasks.remove(node.link)
+                node.link = None
+                self.count_task("unlink", "reverted")
                 return
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        if file in self.dir_task_for and \
-                self.dir_task_for[file].action == "create":
+        if node.dir is not None and node.dir.action == "create":
             internal_error("new unlink operation clashes with planned "
-                    "operation: " + self.dir_task_for[file].action +
+                    "operation: " + node.dir.action +
                     " dir " + file)
 
-        debug(1, "UNLINK: " + file)
-        source = os.readlink(file)
+        self.debug(1, "UNLINK: {}", file)
+        self.count_task("unlink", "queued")
+        source = self.fs.readlink(file)
         task = Task.Link(
             action = "remove",
             type = "link",
@@ -741,20 +2177,23 @@ class Stow:
             source = source,
         )
         self.tasks.append(task)
-        self.link_task_for[file] = task
+        node.link = task
 
     def do_mv(self, src, dst):
-        if src in self.link_task_for:
-            task_ref = self.link_task_for[src]
+        node = self.planned.node(src)
+
+        if node.link is not None:
+            task_ref = node.link
             internal_error("do_mv: pre-existing link task for {}: action: {}, "
                     "source: {}".format(src, task_ref.action, task_ref.source))
-        elif src in self.dir_task_for:
-            task_ref = self.link_task_for[src]
+        elif node.dir is not None:
+            task_ref = node.dir
             internal_error("do_mv: pre-existing dir task for {}?! action: {}" \
                     .format(src, task_ref.action))
 
         # Remove the link
-        debug(1, "MV: " + src + " => " + dst)
+        self.debug(1, "MV: {} => {}", src, dst)
+        self.count_task("mv", "queued")
 
         task = Task.Mv(
             path = src,
@@ -766,8 +2205,10 @@ class Stow:
         # self.mv_task_for[file] = task
 
     def do_mkdir(self, dir):
-        if dir in self.link_task_for:
-            task_ref = self.link_task_for[dir]
+        node = self.planned.node(dir)
+
+        if node.link is not None:
+            task_ref = node.link
             if task_ref.action == "create":
                 internal_error(
                     "new dir clashes with planned new link " +
@@ -779,50 +2220,67 @@ class Stow:
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        if dir in self.dir_task_for:
-            task_ref = self.dir_task_for[dir]
+        if node.dir is not None:
+            task_ref = node.dir
             if task_ref.action == "create":
-                debug(1, "MKDIR: " + dir + " (duplicates previous action)")
+                self.debug(1, "MKDIR: {} (duplicates previous action)", dir)
+                self.count_task("mkdir", "duplicate")
                 return
             elif task_ref.action == "remove":
-                debug(1, "MKDIR: " + dir + " (reverts previous action)")
-                self.dir_task_for[dir].action == "skip"
-                del self.dir_task_for[dir]
+                self.debug(1, "MKDIR: {} (reverts previous action)", dir)
+                self.tasks.remove(node.dir)
+                node.dir = None
+                self.count_task("mkdir", "reverted")
                 return
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        debug(1, "MKDIR: " + dir)
+        self.debug(1, "MKDIR: {}", dir)
+        self.count_task("mkdir", "queued")
         task = Task.Dir(
                 action = "create",
                 type = "dir",
                 path = dir,
         )
         self.tasks.append(task)
-        self.dir_task_for[dir] = task
+        node.dir = task
 
-    def foldable(self, target):
-        debug(3, "--- Is " + target + " foldable?")
+    @instrumented
+    def foldable(self, target, left=None):
+        """
+        The source to fold target to, or "" if it cannot be folded.  left
+        maps the names of children which unstow_node() has just visited
+        to what it left there, sparing another look at them.
+        """
+        self.debug(3, "--- Is {} foldable?", target)
         if self.no_folding:
-            debug(3, "--- no because --no-folding enabled")
+            self.debug(3, "--- no because --no-folding enabled")
             return ""
 
+        left = left or {}
         parent = ""
-        for node in os.listdir(target):
-            path = join_paths(target, node)
+        for node, _ in self.fs.listdir(target):
+            if node in left:
+                source = left[node]
+                if source is None:
+                    continue
+                if source is False:
+                    return ""
+            else:
+                path = join_paths(target, node)
 
-            # Skip nodes scheduled for removal
-            if not self.is_a_node(path):
-                continue
+                # Skip nodes scheduled for removal
+                if not self.is_a_node(path):
+                    continue
 
-            # If it's not a link then we can't fold its parent
-            if not self.is_a_link(path):
-                return ""
+                # If it's not a link then we can't fold its parent
+                if not self.is_a_link(path):
+                    return ""
 
-            # Where is the link pointing?
-            source = self.read_a_link(path)
-            if not source:
-                error("Could not read link " + path)
+                # Where is the link pointing?
+                source = self.read_a_link(path)
+                if not source:
+                    error("Could not read link " + path)
             if parent == "":
                 parent = join_paths(source, os.pardir)
             elif parent != join_paths(source, os.pardir):
@@ -841,44 +2299,49 @@ class Stow:
 
         # If the resulting path is owned by stow, we can fold it
         if self.path_owned_by_package(target, parent):
-            debug(3, "--- target is foldable")
+            self.debug(3, "--- target is foldable")
             return parent
         else:
             return ""
 
     def do_rmdir(self, dir):
-        if dir in self.link_task_for:
-            task_ref = self.link_task_for[dir]
+        node = self.planned.node(dir)
+
+        if node.link is not None:
+            task_ref = node.link
             internal_error("rmdir clashes with planned operation: " +
                     task_ref.action + " link " + task_ref.path + " => "
                     + task_ref.source)
 
-        if dir in self.dir_task_for:
-            task_ref = self.dir_task_for[dir]
+        if node.dir is not None:
+            task_ref = node.dir
 
             if task_ref.action == "remove":
-                debug(1, "RMDIR " + dir + " (duplicates previous action)")
+                self.debug(1, "RMDIR {} (duplicates previous action)", dir)
+                self.count_task("rmdir", "duplicate")
                 return
             elif task_ref.action == "create":
-                debug(1, "MKDIR " + dir + " (reverts previous action)")
-                self.link_task_for[dir].action = "skip"
-                del self.link_task_for[dir]
+                self.debug(1, "MKDIR {} (reverts previous action)", dir)
+                self.tasks.remove(node.dir)
+                node.dir = None
+                self.count_task("rmdir", "reverted")
                 return
             else:
                 internal_error("bad task action: " + task_ref.action)
 
-        debug(1, "RMDIR " + dir)
+        self.debug(1, "RMDIR {}", dir)
+        self.count_task("rmdir", "queued")
         task = Task.Dir(
                 action = "remove",
                 type = "dir",
                 path = dir,
         )
         self.tasks.append(task)
-        self.dir_task_for[dir] = task
+        node.dir = task
 
     def fold_tree(self, target, source):
-        debug(3, "--- Folding tree: " + target + " => " + source)
-        for node in os.listdir(target):
+        self.debug(3, "--- Folding tree: {} => {}", target, source)
+        for node, _ in self.fs.listdir(target):
             if self.is_a_node(join_paths(target, node)):
                 self.do_unlink(join_paths(target, node))
         self.do_rmdir(target)
@@ -888,17 +2351,611 @@ class Stow:
         _, _, package = self.find_stowed_path(target, source)
         return package
 
+    def record_link(self, path, source, old_source=None):
+        """
+        Note for the manifest of the owning package that the link at path
+        will point to source, or will be removed if source is None
+        """
+        _, stow_path, package = self.find_stowed_path(path,
+                source or old_source)
+        if stow_path == self.stow_path:
+            self.manifest_events.append((package, path, source))
+
+    def manifest_file(self, package):
+        return os.path.join(self.stow_dir, ".stow-manifests", package + ".json")
+
+    def read_manifest(self, package):
+        """
+        Load the links recorded for package in our target, or None
+        """
+        try:
+            with open(self.manifest_file(package)) as f:
+                return json.load(f).get(self.target_root)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, package, links):
+        file = self.manifest_file(package)
+        try:
+            with open(file) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            record = {}
+
+        if links:
+            dirs = set()
+            for path in links:
+                path = os.path.dirname(path)
+                while path:
+                    dirs.add(path)
+                    path = os.path.dirname(path)
+            tree = self.snapshots.get(package)
+            if tree is None:
+                tree = record.get(self.target_root, {}).get("tree")
+            record[self.target_root] = {"links": links, "dirs": sorted(dirs)}
+            if tree is not None:
+                record[self.target_root]["tree"] = tree
+        else:
+            record.pop(self.target_root, None)
+
+        if not record:
+            if os.path.exists(file):
+                os.unlink(file)
+            return
+
+        if not os.path.isdir(os.path.dirname(file)):
+            os.mkdir(os.path.dirname(file))
+        with open(file + ".tmp", "w") as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.replace(file + ".tmp", file)
+
+    def write_manifests(self):
+        """
+        Replay the link changes noted while planning onto the manifests
+        of the packages they belong to.  A package stowed in this run
+        starts from nothing, since walking it noted every link it owns;
+        any other package starts from its existing manifest, and is left
+        without one if it had none.  Packages which were snapshotted
+        (see scan_package()) also have their snapshot updated.
+        """
+        links = {}
+        for package in self.snapshots:
+            record = self.read_manifest(package)
+            links[package] = record and record["links"]
+        for package, path, source in self.manifest_events:
+            if path is None:
+                links[package] = {}
+                continue
+            if package not in links:
+                record = self.read_manifest(package)
+                links[package] = record and record["links"]
+            if links[package] is None:
+                continue
+            if source is None:
+                links[package].pop(path, None)
+            else:
+                links[package][path] = source
+
+        for package, package_links in links.items():
+            if package_links is not None:
+                self.write_manifest(package, package_links)
+        self.manifest_events = []
+        self.snapshots = {}
+
+    def drop_manifests(self):
+        """
+        Forget what the manifests of packages whose links changed in a run
+        without --manifest record for our target, since it is now stale
+        """
+        for package in {event[0] for event in self.manifest_events}:
+            if self.read_manifest(package) is not None:
+                self.debug(2, "Dropping stale manifest of {}", package)
+                self.write_manifest(package, {})
+        self.manifest_events = []
+
+    @instrumented
+    def manifest_tree(self, package):
+        """
+        The links recorded in the manifest of package, as a nested dict of
+        target path components for unstow_contents().  Returns None if
+        there is no manifest or the target no longer agrees with it, so
+        that the caller falls back to walking the package.
+        """
+        record = self.read_manifest(package)
+        if record is None:
+            return None
+
+        tree = {}
+        for path, source in record["links"].items():
+            if not self.is_a_link(path) or self.read_a_link(path) != source:
+                self.debug(2, "Manifest of {} disagrees with {}", package, path)
+                return None
+            existing_path, stow_path, owner = \
+                    self.find_stowed_path(path, source)
+            if stow_path != self.stow_path or owner != package or \
+                    not self.fs.exists(existing_path):
+                self.debug(2, "Manifest of {} disagrees with {}", package, path)
+                return None
+
+            node = tree
+            parts = path.split(os.sep)
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+                if node is None:
+                    return None
+            node[parts[-1]] = None
+        return tree
+
+    def scan_cache_file(self):
+        return os.path.join(self.stow_dir, ".stow-scan-cache.json")
+
+    def read_scan_cache(self):
+        """
+        Load the package listings recorded by write_scan_cache()
+        """
+        try:
+            with open(self.scan_cache_file()) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if record.get("version") != 1:
+            return {}
+        return {key: [ino, mtime, [tuple(entry) for entry in listing]]
+                for key, (ino, mtime, listing) in record["dirs"].items()}
+
+    def write_scan_cache(self):
+        """
+        Save the package listings in the scan cache for later runs, on
+        top of any which other instances saved meanwhile
+        """
+        file = self.scan_cache_file()
+        dirs = self.read_scan_cache()
+        dirs.update(self.fs.scanned)
+        tmp = "{}.{}.tmp".format(file, threading.get_ident())
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "dirs": dirs}, f,
+                      separators=(",", ":"), sort_keys=True)
+        os.replace(tmp, file)
+        self.fs.rescanned = False
+
+    def fingerprint(self, path):
+        """
+        The state of the node at path which planning relies on: its kind,
+        and for a link where it points
+        """
+        kind = self.fs.kind(path)
+        if kind == "link":
+            return "link:" + self.fs.readlink(path)
+        return kind
+
+    def listing(self, path):
+        """
+        The names in the directory at path, which folding relies on, or
+        None if it cannot be listed
+        """
+        try:
+            return sorted(name for name, _ in self.fs.listdir(path))
+        except OSError:
+            return None
+
+    def write_plan(self, file):
+        """
+        Save the planned tasks, with fingerprints of every path planning
+        looked at and the listing of every directory it listed (see
+        record_reads), so that load_plan() can queue them later on any
+        identical target without planning again
+        """
+        if self.planned.reads is None:
+            error("cannot write a plan which was made without record_reads")
+        tasks = []
+        for task in self.tasks:
+            if task.action == "move":
+                tasks.append([task.action, task.type, task.path, task.dest])
+            elif task.type == "link":
+                tasks.append([task.action, task.type, task.path, task.source])
+            else:
+                tasks.append([task.action, task.type, task.path])
+
+        reads = self.planned.reads
+        plan = {
+            "version": 2,
+            "stow_path": self.stow_path,
+            "tasks": tasks,
+            "fingerprints": {path: self.fingerprint(path)
+                             for path in sorted(reads)},
+            "listings": {path: self.listing(path)
+                         for path in sorted(self.fs.listed or ())},
+        }
+        if self.manifest:
+            plan["manifest_events"] = self.manifest_events
+            plan["snapshots"] = self.snapshots
+        elif self.manifest_events:
+            plan["stale_manifests"] = sorted(
+                    {event[0] for event in self.manifest_events})
+
+        with open(file + ".tmp", "w") as f:
+            json.dump(plan, f, separators=(",", ":"))
+        os.replace(file + ".tmp", file)
+
+    def load_plan(self, file):
+        """
+        Queue the tasks saved by write_plan() for process_tasks(), after
+        checking that every path they were planned from is still in the
+        same state
+        """
+        with open(file) as f:
+            plan = json.load(f)
+        if plan.get("version") != 2:
+            error("unsupported plan file: " + file)
+        if plan["stow_path"] != self.stow_path:
+            error("plan {} was made for stow dir {}, not {}".format(
+                file, plan["stow_path"], self.stow_path))
+
+        changed = {path for path, fingerprint in plan["fingerprints"].items()
+                   if self.fingerprint(path) != fingerprint}
+        changed.update(path for path, listing in plan["listings"].items()
+                       if self.listing(path) != listing)
+        if changed:
+            error("target has changed since plan {} was made: {}".format(
+                file, ", ".join(sorted(changed)[:10])))
+
+        self.tasks = TaskQueue()
+        for task in plan["tasks"]:
+            if task[0] == "move":
+                self.tasks.append(Task.Mv(path=task[2], dest=task[3]))
+            elif task[1] == "link":
+                self.tasks.append(Task.Link(action=task[0], type=task[1],
+                                            source=task[3], path=task[2]))
+            else:
+                self.tasks.append(Task.Dir(action=task[0], type=task[1],
+                                           path=task[2]))
+        if "manifest_events" in plan:
+            self.manifest = True
+            self.manifest_events = [tuple(e) for e in plan["manifest_events"]]
+            self.snapshots = plan["snapshots"]
+        elif "stale_manifests" in plan:
+            self.manifest_events = [(package, None, None)
+                                    for package in plan["stale_manifests"]]
+
+    def check_report(self, format="text"):
+        """
+        The conflicts found by a --check run, as text or as JSON
+        """
+        if format == "json":
+            return json.dumps({"target": self.target_root,
+                               "conflicts": self.conflicts,
+                               "conflict_count": self.conflict_count,
+                               "tasks": len(self.tasks)},
+                              indent=1, sort_keys=True) + "\n"
+        lines = []
+        for action, packages in sorted(self.conflicts.items()):
+            for package, messages in sorted(packages.items()):
+                lines.append("WARNING! {}ing {} would cause conflicts:"
+                             .format(action, package))
+                lines += ["  * " + message for message in messages]
+        lines.append("{}: {} conflicts, {} tasks".format(
+                self.target_root, self.conflict_count, len(self.tasks)))
+        return "\n".join(lines) + "\n"
+
+    def print_stats(self, format="text"):
+        """
+        Print the --stats report to stderr, as text or as JSON
+        """
+        if self.stats is None:
+            return
+        report = self.stats.json() if format == "json" else self.stats.text()
+        sys.stderr.write(report)
+
+class Inotify:
+    """
+    Minimal ctypes binding to Linux inotify, watching directories for
+    entries being created, removed or renamed
+    """
+
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = \
+            0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event = struct.Struct("iIII")
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify needs Linux")
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def add(self, path):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.dirs[wd] = path
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds (None for ever) for events, returning
+        the directories whose entries changed and any new subdirectories.
+        Returns None instead if events were lost.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set(), set()
+        data = os.read(self.fd, 65536)
+        changed, created = set(), set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs:
+                changed.add(self.dirs[wd])
+                if mask & self.IN_ISDIR and \
+                        mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    created.add(os.path.join(self.dirs[wd], name))
+        return changed, created
+
+class DirPoller:
+    """
+    Fallback for Inotify which stats every watched directory each
+    interval seconds and reports those whose mtime changed or which
+    disappeared.  It cannot tell which entries are new, so new
+    subdirectories are left to the caller.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.dirs = {}
+
+    def close(self):
+        pass
+
+    def add(self, path):
+        # A directory seen before keeps its mtime, so that nothing which
+        # changed since then is missed
+        self.dirs.setdefault(path, os.stat(path).st_mtime_ns)
+
+    def changes(self, timeout):
+        time.sleep(self.interval if timeout is None
+                   else min(timeout, self.interval))
+        changed = set()
+        for path, mtime in list(self.dirs.items()):
+            try:
+                self.dirs[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                # Report it once, as nothing else may notice it is gone
+                del self.dirs[path]
+                changed.add(path)
+                continue
+            if self.dirs[path] != mtime:
+                changed.add(path)
+        return changed, set()
+
+class Watcher:
+    """
+    Keeps packages stowed while files are added to and removed from them.
+    Changed package directories are collected from inotify, or by polling
+    where that is unavailable, until none have arrived for delay seconds.
+    Each batch then only has the nodes added to or removed from those
+    directories planned, on a fresh Stow built from options.
+    """
+
+    def __init__(self, packages, delay=0.1, poll=None, **options):
+        self.packages = packages
+        self.delay = delay
+        self.options = options
+        self.pending = set()
+
+        stow = Stow(**options)
+        self.stow_dir = os.path.abspath(
+                os.path.join(stow.target_root, stow.stow_path))
+        if poll is None:
+            try:
+                self.notify = Inotify()
+            except OSError as e:
+                stow.debug(1, "Cannot use inotify ({}), polling instead", e)
+                self.notify = DirPoller()
+        else:
+            self.notify = DirPoller(poll)
+
+        # Watch before the first scan so that no change can slip between
+        for package in packages:
+            self.watch(stow, package, ".")
+        stow.plan_stow(packages)
+        stow.process_tasks()
+        stow = Stow(**options)
+        self.snapshots = {package: stow.scan_package(package)
+                          for package in packages}
+
+    def watch(self, stow, package, dir):
+        """
+        Watch the package directory at target dir and every directory
+        below it which stowing would consider
+        """
+        try:
+            self.notify.add(os.path.join(self.stow_dir, package, dir))
+            entries = stow.fs.listdir(join_paths(stow.stow_path, package, dir))
+        except OSError:
+            # Already gone again; its parent's change covers that
+            return
+        for node, kind in entries:
+            node_target = join_paths(dir, node)
+            if kind == "dir" and \
+                    not stow.ignore(stow.stow_path, package, node_target):
+                self.watch(stow, package, node_target)
+
+    def locate(self, path):
+        """
+        The package and package-relative directory of a watched path
+        """
+        parts = os.path.relpath(path, self.stow_dir).split(os.sep)
+        return parts[0], join_paths(*parts[1:]) if parts[1:] else "."
+
+    def wait(self, timeout):
+        """
+        Collect changes for up to timeout seconds, returning whether any
+        arrived
+        """
+        changes = self.notify.changes(timeout)
+        if changes is None:
+            # Events were lost, so recheck every directory
+            self.pending.update((package, dir)
+                                for package, tree in self.snapshots.items()
+                                for dir in self.dirs(tree, "."))
+            return True
+        changed, created = changes
+        stow = Stow(**self.options)
+        for path in created:
+            self.watch(stow, *self.locate(path))
+        self.pending.update(self.locate(path) for path in changed)
+        return bool(changed)
+
+    @classmethod
+    def dirs(cls, tree, dir):
+        """
+        The directory dir of a package snapshot and those below it
+        """
+        yield dir
+        for node, kind in tree.items():
+            if isinstance(kind, dict):
+                for subdir in cls.dirs(kind, join_paths(dir, node)):
+                    yield subdir
+
+    def apply(self):
+        """
+        Plan and make the pending changes, returning the Stow which did
+        """
+        stow = Stow(**self.options)
+        snapshots = copy.deepcopy(self.snapshots)
+        # Parents first, so that a removed directory is handled whole
+        for package, dir in sorted(self.pending):
+            if package in snapshots and not stow.fs.isdir(
+                    join_paths(stow.stow_path, package)):
+                # The whole package is gone, and with it every node
+                stow.debug(3, "Watch: package {} was removed", package)
+                for node, kind in snapshots.pop(package).items():
+                    stow.unstow_removed(package, node, kind)
+                continue
+            old, parent, name = snapshots.get(package), None, None
+            for part in [] if dir == "." else dir.split(os.sep):
+                parent, name = old, part
+                old = old.get(part) if isinstance(old, dict) else None
+            if not isinstance(old, dict):
+                # Removed along with a parent directory
+                continue
+            new = stow.plan_dir_changes(package, dir, old)
+            if parent is None:
+                snapshots[package] = new
+            else:
+                parent[name] = new
+            for node, kind in new.items():
+                if isinstance(kind, dict) and \
+                        not isinstance(old.get(node), dict):
+                    self.watch(stow, package, join_paths(dir, node))
+
+        if stow.manifest:
+            for package, _ in self.pending:
+                if package in snapshots:
+                    stow.snapshots[package] = snapshots[package]
+        stow.process_tasks()
+        self.snapshots = snapshots
+        self.pending.clear()
+        return stow
+
+    def run(self):
+        """
+        Apply batches of changes until interrupted.  A batch which
+        conflicts is reported and retried along with the next one.
+        """
+        try:
+            while True:
+                if not self.wait(None):
+                    continue
+                while self.wait(self.delay):
+                    pass
+                try:
+                    self.apply()
+                except (RuntimeError, OSError) as e:
+                    report("stow: " + str(e))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.notify.close()
+
+def stow_targets(targets, plan, jobs=1, process=True, **options):
+    """
+    Make the same changes in several targets, calling plan(stow) to plan
+    them on the Stow of each.  Those share one index of package listings,
+    so each package directory is only listed once however many targets it
+    goes into, and with jobs > 1 that many targets are handled at once.
+    Returns the Stow of each target.
+    """
+    # Adopting moves files into the packages behind the index's back
+    if not options.get("adopt"):
+        options["index"] = {}
+    if options.get("stats"):
+        options["stats"] = Stats()
+
+    def run(target):
+        stow = Stow(target, **options)
+        plan(stow)
+        if process:
+            stow.process_tasks()
+        else:
+            # Every target's Stow is kept, so none may hold on to its
+            # directory descriptors
+            stow.dirs.close()
+        return stow
+
+    if jobs < 2 or len(targets) < 2:
+        return [run(target) for target in targets]
+    # The first target fills the index, rather than every thread listing
+    # the same packages at once
+    first = run(targets[0])
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as pool:
+        return [first] + list(pool.map(run, targets[1:]))
+
+def prefix_regexp(regex):
+    """
+    Compile a --defer or --override regex, which like GNU stow's only
+    matches at the start of a path
+    """
+    return re.compile(r"\A(?:" + regex + ")")
+
 def run_with_args(argv = []):
 
     import argparse
     parser = argparse.ArgumentParser("stow")
     parser.add_argument("-d", "--dir",
             help="Set stow dir to DIR (default is current dir)")
-    parser.add_argument("-t", "--target", metavar="DIR",
-            help="Set target to DIR (default is parent of stow dir)")
+    parser.add_argument("-t", "--target", metavar="DIR", action="append",
+            help="Set target to DIR (default is parent of stow dir); may "
+                 "be given more than once to stow into several targets")
     parser.add_argument("--ignore", metavar="REGEX", action="append",
             default=[], type=re.compile,
             help="Ignore files ending in this Perl regex")
+    parser.add_argument("--defer", metavar="REGEX", action="append",
+            default=[], type=prefix_regexp,
+            help="Don't stow files beginning with this Perl regex if the "
+                 "file is already stowed to another package")
+    parser.add_argument("--override", metavar="REGEX", action="append",
+            default=[], type=prefix_regexp,
+            help="Force stowing files beginning with this Perl regex if the "
+                 "file is already stowed to another package")
     parser.add_argument("--adopt", action="store_true",
             help="(Use with care!) Import existing files into stow package "
                  "from target. Please read docs before using.")
@@ -907,8 +2964,63 @@ def run_with_args(argv = []):
     parser.add_argument("--verbose", nargs="?", type=int, const=1,
             metavar="N",
             help="Set verbosity level")
+    parser.add_argument("--log-json", metavar="FILE", dest="log",
+            type=argparse.FileType("w"),
+            help="Write debug messages to FILE as JSON lines instead of "
+                 "printing them")
     parser.add_argument("-V", "--version", action="store_true",
             help="Show stow version number")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+            help="Plan packages and process tasks on N worker threads")
+    parser.add_argument("--scan-cache", action="store_true",
+            help="Keep the listings of package directories in the stow "
+                 "dir, and only list again those which have changed")
+    parser.add_argument("--manifest", action="store_true",
+            help="Record the links each package creates, and unstow or "
+                 "restow packages from that record")
+    parser.add_argument("-n", "--no", "--simulate", dest="simulate",
+            action="store_true",
+            help="Do not actually make any filesystem changes")
+    parser.add_argument("--stream", action="store_true",
+            help="Make each change as soon as planning the remaining "
+                 "packages cannot affect it, rather than after planning "
+                 "everything; a conflict leaves earlier packages done")
+    parser.add_argument("--swap", metavar="DIR",
+            help="Make the changes below the target subdirectory DIR in a "
+                 "staged copy of it, and swap that in atomically; files "
+                 "written to DIR meanwhile by anything else are lost")
+    parser.add_argument("--write-plan", metavar="FILE",
+            help="Save the planned changes to FILE, with fingerprints of "
+                 "the target entries they depend on")
+    parser.add_argument("--apply-plan", metavar="FILE",
+            help="Make the changes saved by --write-plan, if the target is "
+                 "unchanged, instead of planning any packages")
+    parser.add_argument("--watch", action="store_true",
+            help="Stow the packages, then keep running and stow or unstow "
+                 "whatever is added to or removed from them")
+    parser.add_argument("--watch-delay", metavar="SECONDS", type=float,
+            default=0.1,
+            help="Wait until packages have been unchanged for this long "
+                 "before applying a batch of changes (default 0.1)")
+    parser.add_argument("--poll", metavar="SECONDS", type=float,
+            help="Poll the packages every SECONDS for --watch instead of "
+                 "using inotify")
+    parser.add_argument("--check", action="store_true",
+            help="Plan without changing anything, reporting every "
+                 "conflict rather than stopping at the first; exits with "
+                 "1 if there were any")
+    parser.add_argument("--check-format", choices=("text", "json"),
+            default="text",
+            help="Format of the --check report (default text)")
+    parser.add_argument("--stats", action="store_true",
+            help="Report filesystem calls, planned tasks and timings to "
+                 "stderr after the run")
+    parser.add_argument("--stats-format", choices=("text", "json"),
+            default="text",
+            help="Format of the --stats report (default text)")
+    parser.add_argument("--stats-prometheus", metavar="FILE",
+            help="Write the --stats counters to FILE for the Prometheus "
+                 "node exporter's textfile collector")
 
     args, rest = parser.parse_known_args(argv)
 
@@ -920,11 +3032,31 @@ def run_with_args(argv = []):
     del args.version
 
     args.dir = args.dir or os.environ.get("STOW_DIR", os.getcwd())
-    args.target = args.target or join_paths(args.dir, os.pardir)
+    targets = args.target or [join_paths(args.dir, os.pardir)]
+    args.target = targets[0]
 
     args.verbose = args.verbose or args.v
     del args.v
 
+    stats, stats_format, prometheus = \
+        args.stats, args.stats_format, args.stats_prometheus
+    del args.stats_format, args.stats_prometheus
+    args.stats = bool(stats or prometheus)
+
+    watch, watch_delay, poll = args.watch, args.watch_delay, args.poll
+    del args.watch, args.watch_delay, args.poll
+    stream = args.stream
+    del args.stream
+
+    check, check_format = args.check, args.check_format
+    del args.check_format
+
+    simulate, write_plan, apply_plan = \
+        args.simulate, args.write_plan, args.apply_plan
+    del args.simulate, args.write_plan, args.apply_plan
+    args.record_reads = bool(write_plan)
+    simulate = simulate or args.check
+
     # List which packages we plan to stow/unstow, keeping
     # track of which mode we're in as set by the CLI args.
     pkgs_to_stow = []
@@ -949,13 +3081,79 @@ def run_with_args(argv = []):
         parser.print_help()
         sys.exit(1 if msg else 0)
 
-    if not pkgs_to_stow and not pkgs_to_unstow:
+    if apply_plan:
+        if pkgs_to_stow or pkgs_to_unstow:
+            usage("--apply-plan does not take packages")
+    elif not pkgs_to_stow and not pkgs_to_unstow:
         usage("No packages to stow or unstow")
 
-    stow = Stow(**vars(args))
-    stow.plan_unstow(pkgs_to_unstow)
-    stow.plan_stow(pkgs_to_stow)
-    stow.process_tasks()
+    if len(targets) > 1 and (watch or apply_plan or write_plan or args.swap):
+        usage("--watch, --swap and plan files take a single target")
+
+    if args.swap and not below_target(os.path.normpath(args.swap)):
+        usage("--swap takes a subdirectory of the target")
+
+    if check and (watch or stream or apply_plan or write_plan):
+        usage("--check only plans packages")
+
+    if stream and (simulate or apply_plan or write_plan or args.swap or
+                   len(targets) > 1):
+        usage("--stream makes its changes on a single target directly")
+
+    if watch:
+        if pkgs_to_unstow or apply_plan or write_plan or simulate:
+            usage("--watch only stows packages")
+        Watcher(pkgs_to_stow, watch_delay, poll, **vars(args)).run()
+        if args.log:
+            args.log.close()
+        return
+
+    # Restowing can be planned incrementally from the package manifests
+    restow = [pkg for pkg in pkgs_to_stow if pkg in pkgs_to_unstow] \
+            if args.manifest else []
+
+    def plan(stow):
+        stow.plan_unstow([pkg for pkg in pkgs_to_unstow if pkg not in restow])
+        stow.plan_restow(restow)
+        stow.plan_stow([pkg for pkg in pkgs_to_stow if pkg not in restow])
+
+    if stream:
+        stow = Stow(**vars(args))
+        stow.process_streaming(
+                [("plan_unstow_package", pkg) for pkg in pkgs_to_unstow] +
+                [("plan_stow_package", pkg) for pkg in pkgs_to_stow])
+        stows = [stow]
+    elif len(targets) > 1:
+        del args.target
+        stows = stow_targets(targets, plan, process=not simulate,
+                             **vars(args))
+        stow = stows[0]
+    else:
+        stow = Stow(**vars(args))
+        if apply_plan:
+            stow.load_plan(apply_plan)
+        else:
+            plan(stow)
+            if write_plan:
+                stow.write_plan(write_plan)
+        if not simulate:
+            stow.process_tasks()
+        stows = [stow]
+    if args.log:
+        args.log.close()
+
+    # Runs which never processed tasks have not counted cache hits yet
+    for s in stows:
+        s.count_cache()
+    if stats:
+        stow.print_stats(stats_format)
+    if prometheus:
+        stow.stats.write_prometheus(prometheus)
+    if check:
+        for stow in stows:
+            sys.stdout.write(stow.check_report(check_format))
+        if any(stow.conflict_count for stow in stows):
+            sys.exit(1)
 
 if __name__ == "__main__":
     run_with_args(sys.argv[1:])
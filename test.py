@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import json, os, shutil, subprocess, sys, unittest
+import json, os, re, shutil, subprocess, sys, unittest
 import jsondirs
 import stow
 
@@ -70,5 +70,595 @@ unstow = compareTest("unstow", "simple.json", ["pkg", "-D pkg"])
 unfold = compareTest("unfold", "unfold.json", ["pkg1 pkg2", "-D pkg1 pkg2"])
 abslink = compareTest("abslink", "abslink.json", ["-D pkg"])
 
+
+def planned(stow_obj):
+    return [(t.action, t.type, t.path, getattr(t, "source", None))
+            for t in stow_obj.tasks]
+
+
+class ParallelPlan(unittest.TestCase):
+    """
+    Planning packages on a worker pool must give the serial task list
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "parallel")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        plans = []
+        for jobs in (1, 4):
+            s = stow.Stow(dir, os.path.join(dir, "stow"), jobs=jobs)
+            s.plan_stow(["pkg1", "pkg2"])
+            plans.append(planned(s))
+        self.assertEqual(*plans)
+
+class Reentrant(unittest.TestCase):
+    """
+    Stow instances keep their own state and never change the cwd, so
+    several can run at once
+    """
+
+    def test(self):
+        import threading
+
+        dirs = [os.path.join(tmpdir, "reentrant", str(i)) for i in range(4)]
+        for dir in dirs:
+            jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+
+        cwd = os.getcwd()
+        def run(dir, verbose):
+            s = stow.Stow(dir, os.path.join(dir, "stow"), verbose=verbose)
+            s.plan_stow(["pkg1", "pkg2"])
+            s.process_tasks()
+
+        threads = [threading.Thread(target=run, args=(dir, i % 2))
+                   for i, dir in enumerate(dirs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(os.getcwd(), cwd)
+        for dir in dirs:
+            self.assertEqual(sorted(os.listdir(os.path.join(dir, "dir"))),
+                             ["file1", "file2"])
+
+
+class DirFdBackend(unittest.TestCase):
+    """
+    Target lookups go through directory descriptors, except for absolute
+    paths
+    """
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs dir_fd")
+    def test(self):
+        self.assertTrue(stow.DirFds.supported)
+        dir = os.path.join(tmpdir, "dirfds")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        s.plan_stow(["pkg1", "pkg2"])
+        self.assertIn("stow/pkg1", s.dirs.fds)
+        s.process_tasks()
+        self.assertEqual(sorted(os.listdir(os.path.join(dir, "dir"))),
+                         ["file1", "file2"])
+
+        dir = os.path.join(tmpdir, "dirfds-abs")
+        jsondirs.load(os.path.join("tests", "abslink.json"), dir)
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        s.plan_unstow(["pkg"])
+        self.assertEqual(s.dirs.lstat("/").st_ino, os.lstat("/").st_ino)
+        self.assertEqual(s.dirs.lstat("../" * 64).st_ino, os.lstat("/").st_ino)
+
+
+class Manifest(unittest.TestCase):
+    """
+    Stowing records each package's links; unstowing plans from them
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "manifest")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        stowdir = os.path.join(dir, "stow")
+
+        s = stow.Stow(dir, stowdir, manifest=True)
+        s.plan_stow(["pkg1", "pkg2"])
+        s.process_tasks()
+        s = stow.Stow(dir, stowdir, manifest=True)
+        self.assertEqual(s.read_manifest("pkg1")["links"],
+                         {"dir/file1": "../stow/pkg1/dir/file1"})
+        self.assertEqual(s.manifest_tree("pkg1"), {"dir": {"file1": None}})
+
+        s.plan_unstow(["pkg1", "pkg2"])
+        s.process_tasks()
+        self.assertFalse(os.path.lexists(os.path.join(dir, "dir")))
+        self.assertEqual(os.listdir(os.path.join(stowdir, ".stow-manifests")),
+                         [])
+
+        # A run without --manifest retires the manifests it makes stale
+        s = stow.Stow(dir, stowdir, manifest=True)
+        s.plan_stow(["pkg1", "pkg2"])
+        s.process_tasks()
+        open(os.path.join(stowdir, "pkg1", "dir", "new"), "w").close()
+        s = stow.Stow(dir, stowdir)
+        s.plan_stow(["pkg1"])
+        s.process_tasks()
+        self.assertIsNone(s.read_manifest("pkg1"))
+        self.assertIsNotNone(s.read_manifest("pkg2"))
+        s = stow.Stow(dir, stowdir, manifest=True)
+        s.plan_unstow(["pkg1"])
+        s.process_tasks()
+        self.assertEqual(os.readlink(os.path.join(dir, "dir")),
+                         os.path.join("stow", "pkg2", "dir"))
+
+
+class IncrementalRestow(unittest.TestCase):
+    """
+    Restowing from a manifest only plans what changed in the package
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "incremental-restow")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        stowdir = os.path.join(dir, "stow")
+
+        s = stow.Stow(dir, stowdir, manifest=True)
+        s.plan_stow(["pkg1", "pkg2"])
+        s.process_tasks()
+        os.unlink(os.path.join(stowdir, "pkg1", "dir", "file1"))
+        open(os.path.join(stowdir, "pkg1", "dir", "new"), "w").close()
+
+        s = stow.Stow(dir, stowdir, manifest=True)
+        s.plan_restow(["pkg1"])
+        self.assertEqual(planned(s), [
+            ("remove", "link", "dir/file1", "../stow/pkg1/dir/file1"),
+            ("create", "link", "dir/new", "../stow/pkg1/dir/new"),
+        ])
+        s.process_tasks()
+        self.assertEqual(sorted(os.listdir(os.path.join(dir, "dir"))),
+                         ["file2", "new"])
+        self.assertEqual(stow.Stow(dir, stowdir).read_manifest("pkg1")["tree"],
+                         {"dir": {"new": "file"}})
+
+
+class LocalIgnore(unittest.TestCase):
+    """
+    .stow-local-ignore replaces the default ignore list, and ignored
+    directories are never listed
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "localignore")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        pkg = os.path.join(dir, "stow", "pkg1")
+        os.makedirs(os.path.join(pkg, "node_modules", "x"))
+        with open(os.path.join(pkg, ".stow-local-ignore"), "w") as f:
+            f.write("# comment\n\\.stow-local-ignore\n"
+                    "node_modules  # trailing comment\n")
+        open(os.path.join(pkg, "README"), "w").close()
+
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        s.plan_stow(["pkg1"])
+        self.assertEqual(sorted(planned(s)), [
+            ("create", "link", "README", "stow/pkg1/README"),
+            ("create", "link", "dir", "stow/pkg1/dir"),
+        ])
+        self.assertNotIn("stow/pkg1/node_modules", s.fs.listings)
+        self.assertTrue(s.ignore("stow", "pkg2", "README"))
+        self.assertTrue(s.ignore("stow", "pkg2", "dir/.git"))
+
+
+class DeferOverride(unittest.TestCase):
+    """
+    Conflicting links are deferred to or taken over from other packages
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "defer")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        stowdir = os.path.join(dir, "stow")
+        s = stow.Stow(dir, stowdir)
+        s.plan_stow(["pkg1"])
+        s.process_tasks()
+
+        s = stow.Stow(dir, stowdir, defer=[stow.prefix_regexp("di")])
+        s.plan_stow(["pkg2"])
+        self.assertEqual(planned(s), [])
+        self.assertEqual(s.deferred, {"dir": True})
+
+        s = stow.Stow(dir, stowdir, override=[stow.prefix_regexp("di")])
+        s.plan_stow(["pkg2"])
+        self.assertEqual(planned(s), [
+            ("remove", "link", "dir", "stow/pkg1/dir"),
+            ("create", "link", "dir", "stow/pkg2/dir"),
+        ])
+        self.assertFalse(stow.Stow(dir, stowdir, override=[
+            stow.prefix_regexp("ir")]).override("dir"))
+        # Backreferences keep referring to their own pattern's groups
+        s = stow.Stow(dir, stowdir, ignore=[re.compile(r"(a)\1"),
+                                            re.compile(r"(b)\1")])
+        self.assertTrue(s.ignore("stow", "pkg1", "bb"))
+
+
+class JsonLog(unittest.TestCase):
+    """
+    Debug messages can be written as JSON lines, and are never formatted
+    when they are not reported
+    """
+
+    def test(self):
+        import io
+
+        dir = os.path.join(tmpdir, "jsonlog")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        log = io.StringIO()
+        s = stow.Stow(dir, os.path.join(dir, "stow"), verbose=1, log=log)
+        s.plan_stow(["pkg1"])
+        s.debug(2, "{0[x]}", None)  # would raise if it were formatted
+        events = [json.loads(line) for line in log.getvalue().splitlines()]
+        self.assertEqual(events, [{
+            "level": 1,
+            "event": "LINK: {} => {}",
+            "args": ["dir", "stow/pkg1/dir"],
+            "message": "LINK: dir => stow/pkg1/dir",
+        }])
+
+
+class Stats(unittest.TestCase):
+    """
+    --stats counts filesystem calls by method and tasks by outcome
+    """
+
+    def test(self):
+        dir = os.path.join(tmpdir, "stats")
+        jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+        s = stow.Stow(dir, os.path.join(dir, "stow"), stats=True)
+        s.plan_stow(["pkg1", "pkg2"])
+        s.process_tasks()
+
+        counts = {(r["metric"], tuple(sorted(r["labels"].items()))): r["value"]
+                  for r in s.stats.records()}
+        self.assertEqual(counts[("tasks", (("outcome", "queued"),
+                                           ("type", "link")))], 3)
+        self.assertEqual(counts[("tasks", (("outcome", "reverted"),
+                                           ("type", "unlink")))], 1)
+        self.assertEqual(counts[("fs_calls", (("method", "stow_contents"),
+                                              ("op", "listdir")))], 4)
+        self.assertEqual(counts[("fs_calls", (("method", "unfold_contents"),
+                                              ("op", "listdir")))], 1)
+        self.assertIn('stow_tasks_total{outcome="queued",type="mkdir"} 1\n',
+                      s.stats.prometheus())
+
+        # A simulated run still reports its cache hits
+        prom = os.path.join(tmpdir, "stats.prom")
+        stow.run_with_args(["-n", "-d", os.path.join(dir, "stow"), "-t", dir,
+                            "--stats-prometheus", prom, "pkg1"])
+        with open(prom) as f:
+            self.assertIn("stow_fs_cache_hits_total", f.read())
+
+        # A package name after --stats is not taken for the format
+        import contextlib, io
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            stow.run_with_args(["-n", "-d", os.path.join(dir, "stow"),
+                                "-t", dir, "--stats-format", "json",
+                                "--stats", "pkg1"])
+        self.assertIn("fs_cache_hits",
+                      [r["metric"] for r in json.loads(err.getvalue())])
+
+
+class Plan(unittest.TestCase):
+    """
+    A saved plan applies to an identical target, but not a changed one
+    """
+
+    def test(self):
+        dirs = [os.path.join(tmpdir, "plan", str(i)) for i in range(3)]
+        for dir in dirs:
+            jsondirs.load(os.path.join("tests", "unfold.json"), dir)
+            s = stow.Stow(dir, os.path.join(dir, "stow"))
+            s.plan_stow(["pkg1"])
+            s.process_tasks()
+        file = os.path.join(tmpdir, "plan", "plan.json")
+
+        # A plan must know what it was made from to be checked later
+        s = stow.Stow(dirs[0], os.path.join(dirs[0], "stow"))
+        s.plan_stow(["pkg2"])
+        self.assertRaises(RuntimeError, s.write_plan, file)
+
+        s = stow.Stow(dirs[0], os.path.join(dirs[0], "stow"),
+                      record_reads=True)
+        s.plan_stow(["pkg2"])
+        s.write_plan(file)
+
+        s = stow.Stow(dirs[1], os.path.join(dirs[1], "stow"))
+        s.load_plan(file)
+        s.process_tasks()
+        self.assertEqual(sorted(os.listdir(os.path.join(dirs[1], "dir"))),
+                         ["file1", "file2"])
+
+        os.unlink(os.path.join(dirs[2], "dir"))
+        s = stow.Stow(dirs[2], os.path.join(dirs[2], "stow"))
+        self.assertRaises(RuntimeError, s.load_plan, file)
+
+        # Folding relies on what else is in the directory it folds
+        tree = {"stow": {"pkg1": {"share": {"a": ""}},
+                         "pkg2": {"share": {"b": ""}}}}
+        dirs = [os.path.join(tmpdir, "plan", "fold", str(i)) for i in range(2)]
+        for dir in dirs:
+            jsondirs.mktree(tree, dir)
+            s = stow.Stow(dir, os.path.join(dir, "stow"))
+            s.plan_stow(["pkg1", "pkg2"])
+            s.process_tasks()
+        s = stow.Stow(dirs[0], os.path.join(dirs[0], "stow"),
+                      record_reads=True)
+        s.plan_unstow(["pkg2"])
+        s.write_plan(file)
+
+        open(os.path.join(dirs[1], "share", "local"), "w").close()
+        s = stow.Stow(dirs[1], os.path.join(dirs[1], "stow"))
+        self.assertRaises(RuntimeError, s.load_plan, file)
+        self.assertEqual(sorted(os.listdir(os.path.join(dirs[1], "share"))),
+                         ["a", "b", "local"])
+
+
+class Swap(unittest.TestCase):
+    """
+    Changes below a swapped dir are made on a staged copy of it
+    """
+
+    def test(self):
+        tree = {
+            "bin": {"local": "x"},
+            "stow": {"pkg1": {"bin": {"a": ""}},
+                     "pkg2": {"bin": {"b": ""}}},
+        }
+        exchange = stow.rename_exchange
+        for fallback in (False, True):
+            dir = os.path.join(tmpdir, "swap", str(fallback))
+            jsondirs.mktree(tree, dir)
+            bin = os.path.join(dir, "bin")
+            if fallback:
+                stow.rename_exchange = lambda a, b: False
+            try:
+                for pkg in ("pkg1", "pkg2"):
+                    inode = os.stat(bin).st_ino
+                    s = stow.Stow(dir, os.path.join(dir, "stow"), swap="bin")
+                    s.plan_stow([pkg])
+                    s.process_tasks()
+                    self.assertNotEqual(os.stat(bin).st_ino, inode)
+            finally:
+                stow.rename_exchange = exchange
+            self.assertEqual(sorted(os.listdir(dir)), ["bin", "stow"])
+            self.assertEqual(sorted(os.listdir(bin)), ["a", "b", "local"])
+
+        for swap in ("../outside", "bin/../..", "/", ".", ".."):
+            self.assertRaises(RuntimeError, stow.Stow, dir,
+                              os.path.join(dir, "stow"), swap=swap)
+
+
+class Watch(unittest.TestCase):
+    """
+    Watching stows what is added to a package and unstows what is removed
+    """
+
+    def test(self):
+        tree = {"stow": {"pkg1": {"share": {"a": {"f": ""}}},
+                         "pkg2": {"share": {"b": {"g": ""}}}}}
+        for poll in (None, 0.01):
+            dir = os.path.join(tmpdir, "watch", str(poll))
+            jsondirs.mktree(tree, dir)
+            pkg1 = os.path.join(dir, "stow", "pkg1")
+            w = stow.Watcher(["pkg1", "pkg2"], 0.05, poll,
+                             target=dir, dir=os.path.join(dir, "stow"))
+            try:
+                os.makedirs(os.path.join(pkg1, "lib", "c"))
+                shutil.rmtree(os.path.join(pkg1, "share"))
+                while w.wait(0.2):
+                    pass
+                w.apply()
+                self.assertEqual(os.readlink(os.path.join(dir, "lib")),
+                                 os.path.join("stow", "pkg1", "lib"))
+                # Without pkg1, share/ folds back into pkg2
+                self.assertEqual(os.readlink(os.path.join(dir, "share")),
+                                 os.path.join("stow", "pkg2", "share"))
+                self.assertEqual(w.snapshots["pkg1"],
+                                 {"lib": {"c": {}}})
+
+                # Removing a whole package unstows everything it had
+                shutil.rmtree(os.path.join(dir, "stow", "pkg2"))
+                while w.wait(0.2):
+                    pass
+                w.apply()
+                self.assertFalse(os.path.lexists(os.path.join(dir, "share")))
+                self.assertNotIn("pkg2", w.snapshots)
+                # and later batches still apply
+                os.makedirs(os.path.join(pkg1, "etc"))
+                while w.wait(0.2):
+                    pass
+                w.apply()
+                self.assertTrue(os.path.islink(os.path.join(dir, "etc")))
+            finally:
+                w.notify.close()
+
+
+class FanOut(unittest.TestCase):
+    """
+    Stowing into several targets lists each package directory once
+    """
+
+    def test(self):
+        tree = {"stow": {"pkg1": {"bin": {"a": ""}},
+                         "pkg2": {"bin": {"b": ""}}},
+                "t1": {}, "t2": {}}
+        dir = os.path.join(tmpdir, "fanout")
+        jsondirs.mktree(tree, dir)
+        targets = [os.path.join(dir, "t1"), os.path.join(dir, "t2")]
+        stows = stow.stow_targets(targets,
+                lambda s: s.plan_stow(["pkg1", "pkg2"]),
+                dir=os.path.join(dir, "stow"), stats=True)
+        for target in targets:
+            self.assertEqual(sorted(os.listdir(os.path.join(target, "bin"))),
+                             ["a", "b"])
+        # Four package dirs, plus unfolding bin/ in each target
+        listdirs = sum(r["value"] for r in stows[0].stats.records()
+                       if r["labels"].get("op") == "listdir")
+        self.assertEqual(listdirs, 6)
+
+        # Nothing is left open, whether or not there was anything to do
+        for process in (True, False):
+            stows = stow.stow_targets(targets,
+                    lambda s: s.plan_stow(["pkg1", "pkg2"]),
+                    process=process, dir=os.path.join(dir, "stow"))
+            self.assertEqual([s.dirs.fds for s in stows], [{}, {}])
+
+
+class ScanCache(unittest.TestCase):
+    """
+    Package dirs are only listed again once their mtime changes
+    """
+
+    def test(self):
+        tree = {"stow": {"pkg": {"bin": {"a": ""}, "lib": {"b": ""}}}}
+        dir = os.path.join(tmpdir, "scancache")
+        jsondirs.mktree(tree, dir)
+        for path in ("", "pkg", "pkg/bin", "pkg/lib"):
+            os.utime(os.path.join(dir, "stow", path), (0, 0))
+
+        def stow_pkg():
+            s = stow.Stow(dir, os.path.join(dir, "stow"), stats=True,
+                          scan_cache=True)
+            s.plan_stow(["pkg"])
+            s.process_tasks()
+            return [r["value"] for r in s.stats.records()
+                    if r["labels"].get("op") == "listdir"]
+
+        # The target dir and pkg/
+        self.assertEqual(stow_pkg(), [2])
+        self.assertEqual(stow_pkg(), [1])
+        os.utime(os.path.join(dir, "stow", "pkg"))
+        self.assertEqual(stow_pkg(), [2])
+
+
+class Stream(unittest.TestCase):
+    """
+    Streaming yields a task once no package still to plan claims its path
+    """
+
+    def test(self):
+        tree = {"stow": {"pkg1": {"bin": {"a": ""}},
+                         "pkg2": {"lib": {"b": ""}},
+                         "pkg3": {"bin": {"c": ""}}}}
+        dir = os.path.join(tmpdir, "stream")
+        jsondirs.mktree(tree, dir)
+        steps = [("plan_stow_package", pkg)
+                 for pkg in ("pkg1", "pkg2", "pkg3")]
+
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        tasks = s.stream_tasks(steps)
+        self.assertEqual(next(tasks).path, "lib")
+        # pkg3 is still to come, so pkg1's bin link is held back
+        self.assertEqual([task.path for task in s.tasks], ["bin"])
+        self.assertEqual(sorted(task.path for task in tasks),
+                         ["bin", "bin/a", "bin/c"])
+
+        stow.Stow(dir, os.path.join(dir, "stow")).process_streaming(steps)
+        self.assertEqual(sorted(os.listdir(os.path.join(dir, "bin"))),
+                         ["a", "c"])
+        self.assertTrue(os.path.islink(os.path.join(dir, "lib")))
+
+
+class Check(unittest.TestCase):
+    """
+    A check carries on past conflicts and records them all
+    """
+
+    def test(self):
+        tree = {"bin": {"a": "x", "b": "x"},
+                "stow": {"pkg1": {"bin": {"a": ""}},
+                         "pkg2": {"bin": {"b": "", "c": ""}}}}
+        dir = os.path.join(tmpdir, "check")
+        jsondirs.mktree(tree, dir)
+        s = stow.Stow(dir, os.path.join(dir, "stow"), check=True)
+        s.plan_stow(["pkg1", "pkg2"])
+        self.assertEqual(s.conflicts["stow"], {
+            "pkg1": ["existing target is neither a link nor a dir: bin/a"],
+            "pkg2": ["existing target is neither a link nor a dir: bin/b"],
+        })
+        self.assertEqual(planned(s), [("create", "link", "bin/c",
+                                       "../stow/pkg2/bin/c")])
+        report = json.loads(s.check_report("json"))
+        self.assertEqual(report["conflict_count"], 2)
+
+
+class UnstowFold(unittest.TestCase):
+    """
+    Unstowing folds directories from what it left behind in them
+    """
+
+    def test(self):
+        tree = {"stow": {"pkg1": {"a": {"b": {"c": ""}}},
+                         "pkg2": {"a": {"b": {"d": ""}, "e": ""}}}}
+        dir = os.path.join(tmpdir, "unstowfold")
+        jsondirs.mktree(tree, dir)
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        s.plan_stow(["pkg1", "pkg2"])
+        s.process_tasks()
+        s = stow.Stow(dir, os.path.join(dir, "stow"))
+        s.plan_unstow(["pkg2"])
+        # b/ folds first, then a/ since b is now a link too
+        self.assertEqual(planned(s)[-1],
+                         ("create", "link", "a", "stow/pkg1/a"))
+        s.process_tasks()
+        self.assertEqual(os.readlink(os.path.join(dir, "a")),
+                         os.path.join("stow", "pkg1", "a"))
+
+
+class SharedUnfold(unittest.TestCase):
+    """
+    Stowing many packages into one shared dir lists each package dir once
+    and never looks below the unfolded dirs in the target
+    """
+
+    def test(self):
+        for count in (2, 4):
+            tree = {"stow": {"pkg{}".format(i): {"share": {"d": {
+                        "f{}".format(i): "", "g{}".format(i): ""}}}
+                             for i in range(count)}}
+            dir = os.path.join(tmpdir, "sharedunfold", str(count))
+            jsondirs.mktree(tree, dir)
+            s = stow.Stow(dir, os.path.join(dir, "stow"), stats=True)
+            s.plan_stow(["pkg{}".format(i) for i in range(count)])
+            calls = {}
+            for r in s.stats.records():
+                if r["metric"] == "fs_calls":
+                    op = r["labels"]["op"]
+                    calls[op] = calls.get(op, 0) + r["value"]
+                    self.assertNotEqual(r["labels"]["method"], "is_a_link")
+            # Three dirs per package, plus the target
+            self.assertEqual(calls["listdir"], 3 * count + 1)
+            s.process_tasks()
+            self.assertEqual(len(os.listdir(os.path.join(dir, "share", "d"))),
+                             2 * count)
+
+
+class TaskDependencies(unittest.TestCase):
+    """
+    Tasks on a path or its ancestors keep their order; others are free
+    """
+
+    def test(self):
+        Link, Dir = stow.Task.Link, stow.Task.Dir
+        tasks = [
+            Link("remove", "link", "stow/pkg/dir", "dir"),  # unfold dir
+            Dir("create", "dir", "dir"),
+            Link("create", "link", "../stow/pkg/dir/a", "dir/a"),
+            Link("remove", "link", "x/b", "x/b"),           # fold x
+            Dir("remove", "dir", "x"),
+            Link("create", "link", "stow/pkg/x", "x"),
+            Link("create", "link", "stow/pkg/y", "y"),
+        ]
+        deps = stow.task_dependencies(tasks)
+        self.assertEqual(deps, [set(), {0}, {1}, set(), {3}, {4}, set()])
+
+
 if __name__ == "__main__":
     unittest.main()